@@ -0,0 +1,82 @@
+"""Checks that every query of the bot is served by an index.
+
+Runs explain() for each query against the configured database and exits with
+code 1 if any of the winning plans contains COLLSCAN. Usage:
+
+    python audit_indexes.py
+"""
+import sys
+
+from bson import ObjectId
+
+import globals as g
+import database as db
+
+logger = g.Logger(__name__)
+
+
+def queries() -> dict:
+    """Returns query sets built by the same functions as the queries of the bot."""
+    day = db.get_day()
+    race_id = ObjectId()
+
+    return {
+        "get_payment": db.payment_query(0, race_id),
+        "verify_payment": db.payment_id_query(0),
+        "get_unverified_payments": db.unverified_payments_query(),
+        "get_registration": db.registration_query(race_id, 0),
+        "iter_participants": db.registrations_query(race_id),
+        "iter_participants by race number": db.registrations_query(
+            race_id, "race_number"
+        ),
+        "iter_participants users": db.users_query([0]),
+        "get_user": db.user_query(0),
+        "get_upcoming_races": db.upcoming_races_query(day.now),
+        "get_race_by_date": db.races_between_query(day.begin, day.end),
+        "get_race_by_id": db.race_query(race_id),
+        "get_upcoming_race_by_name": db.upcoming_race_query("", day.now),
+        "get_race_telemetry": db.telemetry_query(race_id),
+    }
+
+
+def stages(plan) -> set[str]:
+    """Returns names of all stages in the query plan."""
+    found = set()
+
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            found.add(plan["stage"])
+        for value in plan.values():
+            found |= stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            found |= stages(value)
+
+    return found
+
+
+def audit() -> list[str]:
+    """Returns names of queries which scan the whole collection."""
+    db.ensure_indexes.sync()
+
+    failed = []
+    for name, queryset in queries().items():
+        plan = queryset.explain()["queryPlanner"]["winningPlan"]
+        plan_stages = stages(plan)
+
+        if "COLLSCAN" in plan_stages:
+            failed.append(name)
+            logger.error(f"Query {name} does COLLSCAN, stages: {plan_stages}.")
+        else:
+            logger.info(f"Query {name} uses stages: {plan_stages}.")
+
+    return failed
+
+
+if __name__ == "__main__":
+    failed = audit()
+    if failed:
+        logger.error(f"{len(failed)} queries are not covered by indexes: {failed}.")
+        sys.exit(1)
+
+    logger.info("All queries are covered by indexes.")
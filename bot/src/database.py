@@ -1,12 +1,17 @@
 import os
+import asyncio
 import csv
+import functools
 import tarfile
 import shutil
 
 from datetime import datetime
 from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import BinaryIO
 
-import pandas as pd
+from pymongo import UpdateOne
 
 from mongoengine import (
     connect,
@@ -19,11 +24,13 @@ from mongoengine import (
     DateTimeField,
     ReferenceField,
     BooleanField,
-    DictField,
     SequenceField,
+    NotUniqueError,
 )
 
 import globals as g
+import export
+from roster import Roster
 
 logger = g.Logger(__name__)
 
@@ -39,6 +46,44 @@ logger.info(
     f"Connection to MongoDB databases {cinfo.list_database_names()} is established."
 )
 
+# Number of registrations for which users are fetched with a single query.
+PARTICIPANTS_BATCH_SIZE = 500
+
+PARTICIPANTS_COLUMNS = [
+    "Номер",
+    "Пол",
+    "Дата рождения",
+    "Категория",
+    "Полное имя",
+    "Telegram ID",
+    "Телефон",
+    "Email",
+]
+
+# Every query runs in one of these threads, so handlers awaiting the database
+# don't block the event loop and their queries overlap.
+DB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DB_WORKERS", 8)), thread_name_prefix="db"
+)
+
+
+def threaded(func):
+    """Turns blocking function into a coroutine function running in DB_EXECUTOR.
+
+    The blocking function is still available as func.sync to be called from
+    other functions which already run in the executor.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            DB_EXECUTOR, functools.partial(func, *args, **kwargs)
+        )
+
+    wrapper.sync = func
+    return wrapper
+
 
 class User(Document):
     telegram_id = IntField(required=True, unique=True)
@@ -68,19 +113,26 @@ class Race(Document):
 
     registration_open = BooleanField(default=True)
 
-    participants = ListField(ReferenceField(User))
-    participants_infos = ListField(
-        DictField(
-            fields={
-                "telegram_id": IntField(required=True),
-                "category": StringField(required=True),
-                "race_number": IntField(default=0),
-            },
-        )
-    )
-
     ended = BooleanField(default=False)
 
+    # Not strict, since old documents may still have participants arrays which
+    # are moved to Registration by migrate_registrations.
+    meta = {"indexes": [("name", "start"), "start"], "strict": False}
+
+
+class Registration(Document):
+    race = ReferenceField(Race, required=True)
+    telegram_id = IntField(required=True)
+    category = StringField(required=True)
+    race_number = IntField(default=0)
+
+    meta = {
+        "indexes": [
+            {"fields": ["race", "telegram_id"], "unique": True},
+            ("race", "race_number"),
+        ]
+    }
+
 
 class Payment(Document):
     payment_id = SequenceField(sequence_name="payment_id", required=True, unique=True)
@@ -93,26 +145,145 @@ class Payment(Document):
 
     verified = BooleanField(default=False)
 
+    meta = {"indexes": [("race", "telegram_id"), "verified"]}
+
+
+class Telemetry(Document):
+    """Single live position of a rider, written in batches by telemetry.WRITER."""
+
+    race = ReferenceField(Race, required=True)
+    telegram_id = IntField(required=True)
+    # Epoch time when the position was received.
+    timestamp = FloatField(required=True)
+    coordinates = ListField(FloatField(required=True), required=True)
+
+    meta = {"indexes": [("race", "timestamp")]}
+
+
+# Query sets are built by these functions only, so audit_indexes explains
+# exactly the queries which are sent to the database.
+def payment_query(telegram_id, race):
+    return Payment.objects(telegram_id=telegram_id, race=race)
+
+
+def payment_id_query(payment_id):
+    return Payment.objects(payment_id=payment_id)
+
+
+def unverified_payments_query():
+    return Payment.objects(verified=False)
+
+
+def user_query(telegram_id):
+    return User.objects(telegram_id=telegram_id)
+
+
+def users_query(telegram_ids: list[int]):
+    return User.objects(telegram_id__in=telegram_ids)
+
+
+def registration_query(race, telegram_id):
+    return Registration.objects(race=race, telegram_id=telegram_id)
+
+
+def registrations_query(race, order_by: str = "id"):
+    return Registration.objects(race=race).order_by(order_by)
+
+
+def upcoming_races_query(now):
+    return Race.objects(start__gte=now).order_by("start")
+
+
+def races_between_query(begin, end):
+    return Race.objects(start__gte=begin, start__lte=end)
+
+
+def race_query(race_id):
+    return Race.objects(id=race_id)
+
+
+def upcoming_race_query(name: str, now):
+    return Race.objects(name=name, start__gte=now)
+
+
+def telemetry_query(race):
+    return (
+        Telemetry.objects(race=race)
+        .only("telegram_id", "timestamp", "coordinates")
+        .order_by("timestamp")
+    )
+
+
+@threaded
+def ensure_indexes():
+    """Creates indexes declared in meta of the documents, if they're missing."""
+    for document in (User, Race, Registration, Payment, Telemetry):
+        document.ensure_indexes()
+
+    logger.info("Indexes of all collections are ensured.")
+
+
+@threaded
+def migrate_registrations():
+    """Moves participants from legacy arrays of race documents to Registration."""
+    races = Race._get_collection()
+
+    for race in races.find(
+        {"participants_infos": {"$exists": True}}, {"name": 1, "participants_infos": 1}
+    ):
+        participants_infos = race.get("participants_infos") or []
+
+        updates = [
+            UpdateOne(
+                {"race": race["_id"], "telegram_id": participant_info["telegram_id"]},
+                {
+                    "$setOnInsert": {
+                        "category": participant_info["category"],
+                        "race_number": int(participant_info.get("race_number", 0)),
+                    }
+                },
+                upsert=True,
+            )
+            for participant_info in participants_infos
+        ]
+        if updates:
+            # Ordered, so registrations keep the order of the legacy array.
+            Registration._get_collection().bulk_write(updates, ordered=True)
+
+        races.update_one(
+            {"_id": race["_id"]},
+            {"$unset": {"participants": "", "participants_infos": ""}},
+        )
+
+        logger.info(
+            f"Moved {len(participants_infos)} participants of race {race['name']} "
+            "to registrations."
+        )
+
 
-async def get_payment(telegram_id, race):
-    payment = Payment.objects(telegram_id=telegram_id, race=race).first()
+@threaded
+def get_payment(telegram_id, race):
+    payment = payment_query(telegram_id, race).first()
     return payment
 
 
-async def verify_payment(payment_id):
-    payment = Payment.objects(payment_id=payment_id).first()
+@threaded
+def verify_payment(payment_id):
+    payment = payment_id_query(payment_id).first()
     payment.update(verified=True)
     payment.save()
 
     return payment
 
 
-async def get_unverified_payments():
-    payments = Payment.objects(verified=False)
+@threaded
+def get_unverified_payments():
+    payments = list(unverified_payments_query().select_related())
     return payments
 
 
-async def new_payment(telegram_id, full_name, race, price):
+@threaded
+def new_payment(telegram_id, full_name, race, price):
     date = get_day().now
 
     payment = {
@@ -126,8 +297,34 @@ async def new_payment(telegram_id, full_name, race, price):
     Payment(**payment).save()
 
 
-async def get_user(telegram_id):
-    user = User.objects(telegram_id=telegram_id).first()
+@threaded
+def insert_telemetry(points: list[dict]):
+    """Writes raw telemetry documents with a single round trip, blocking."""
+    Telemetry._get_collection().insert_many(points, ordered=False)
+
+
+@threaded
+def get_race_telemetry(race) -> dict[int, list[tuple[float, float, float]]]:
+    """Returns all positions of the race as (timestamp, lat, lon) by telegram id."""
+    cursor = telemetry_query(race).as_pymongo().batch_size(10_000)
+
+    telemetry = defaultdict(list)
+    for point in cursor:
+        latitude, longitude = point["coordinates"]
+        telemetry[point["telegram_id"]].append(
+            (point["timestamp"], latitude, longitude)
+        )
+
+    logger.debug(
+        f"Loaded telemetry of {len(telemetry)} riders for race with name {race.name}."
+    )
+
+    return dict(telemetry)
+
+
+@threaded
+def get_user(telegram_id):
+    user = user_query(telegram_id).first()
 
     if user:
         logger.debug(f"User with telegram id {telegram_id} is found in the database.")
@@ -139,37 +336,25 @@ async def get_user(telegram_id):
     return user
 
 
-async def remove_participant(race, telegram_id):
-    participant_info_idx = 0
-    participant_info_exists = False
-    for participant_info in race.participants_infos:
-        if participant_info["telegram_id"] == telegram_id:
-            participant_info_exists = True
-            break
-        participant_info_idx += 1
-
-    participant_idx = 0
-    participant_exists = False
-    for participant in race.participants:
-        if participant.telegram_id == telegram_id:
-            participant_exists = True
-            break
-        participant_idx += 1
-
-    if not participant_info_exists or not participant_exists:
+@threaded
+def remove_participant(race, telegram_id):
+    registration = registration_query(race, telegram_id).modify(remove=True)
+    if not registration:
         return
 
+    participant = user_query(telegram_id).first()
+    if participant:
+        full_name = f"{participant.last_name} {participant.first_name}"
+    else:
+        full_name = "Не найден"
+
     info = {
-        "Telegram ID": participant.telegram_id,
-        "Имя": f"{participant.last_name} {participant.first_name}",
-        "Категория": participant_info["category"],
+        "Telegram ID": telegram_id,
+        "Имя": full_name,
+        "Категория": registration.category,
     }
 
-    race.participants_infos.pop(participant_info_idx)
-    race.participants.pop(participant_idx)
-    race.save()
-
-    payment = await get_payment(telegram_id, race)
+    payment = get_payment.sync(telegram_id, race)
 
     if payment:
         info["Сумма платежа"] = payment.price
@@ -185,22 +370,42 @@ async def remove_participant(race, telegram_id):
     return info
 
 
-async def get_participant_info(race, telegram_id):
-    for participant_info in race.participants_infos:
-        if participant_info["telegram_id"] == telegram_id:
-            return participant_info["category"], participant_info["race_number"]
+@threaded
+def get_registration(race, telegram_id):
+    return registration_query(race, telegram_id).first()
 
 
-async def get_participant_by_race_number(race, race_number):
-    for participant, participant_info in zip(
-        race.participants, race.participants_infos
-    ):
-        if int(participant_info["race_number"]) == race_number:
-            return participant, participant_info["category"]
+def iter_participants(race, order_by: str = "id"):
+    """Yields registrations of the race with their users.
+
+    Registrations are read from a cursor and users are fetched with a single
+    query per batch, so memory doesn't grow with the number of participants.
+    Runs queries while iterated, so must be consumed in DB_EXECUTOR.
+    """
+    registrations = iter(registrations_query(race, order_by))
+
+    while batch := list(islice(registrations, PARTICIPANTS_BATCH_SIZE)):
+        telegram_ids = [registration.telegram_id for registration in batch]
+        users = {user.telegram_id: user for user in users_query(telegram_ids)}
+
+        for registration in batch:
+            user = users.get(registration.telegram_id)
+            if user:
+                yield registration, user
+
 
+@threaded
+def get_roster(race) -> Roster:
+    roster = Roster.build(iter_participants(race))
 
-async def update_user(telegram_id, **kwargs):
-    user = User.objects(telegram_id=telegram_id).first()
+    logger.debug(f"Built roster with {len(roster)} participants for race {race.name}.")
+
+    return roster
+
+
+@threaded
+def update_user(telegram_id, **kwargs):
+    user = user_query(telegram_id).first()
 
     if user:
         logger.debug(
@@ -219,30 +424,33 @@ async def update_user(telegram_id, **kwargs):
     return user
 
 
-async def new_user(**kwargs):
+@threaded
+def new_user(**kwargs):
     logger.debug(f"Trying to create a new user with data: {kwargs}.")
     return User(**kwargs).save()
 
 
-async def get_upcoming_races():
+@threaded
+def get_upcoming_races():
     day = get_day()
 
     logger.debug(f"Trying to get list of upcoming races after {day.begin}.")
 
-    races = Race.objects(start__gte=day.now).order_by("start")
+    races = list(upcoming_races_query(day.now))
 
     logger.debug(f"Found {len(races)} races after {day.now}.")
 
     return races
 
 
-async def get_race_by_date(day: str = None):
+@threaded
+def get_race_by_date(day: str = None):
     if not day:
         day = get_day()
     else:
         day = get_day(day)
 
-    race = Race.objects(start__gte=day.begin, start__lte=day.end).first()
+    race = races_between_query(day.begin, day.end).first()
 
     if race:
         logger.debug(f"Found race {race.name} between {day.begin} and {day.end}.")
@@ -251,12 +459,23 @@ async def get_race_by_date(day: str = None):
     return race
 
 
-async def get_upcoming_race_by_name(name: str):
+@threaded
+def get_race_by_id(race_id: str):
+    race = race_query(race_id).first()
+
+    if not race:
+        logger.debug(f"Can't find race with id {race_id}.")
+
+    return race
+
+
+@threaded
+def get_upcoming_race_by_name(name: str):
     logger.debug(f"Trying to find upcoming race with name {name}.")
 
     day = get_day()
 
-    race = Race.objects(name=name, start__gte=day.now).first()
+    race = upcoming_race_query(name, day.now).first()
 
     if race:
         logger.debug(f"Race with name {name} is found.")
@@ -266,83 +485,110 @@ async def get_upcoming_race_by_name(name: str):
     return race
 
 
-async def register_to_race(telegram_id, race_name, category):
+@threaded
+def register_to_race(telegram_id, race_name, category):
     logger.debug(
         f"Trying to register user with telegram id {telegram_id} for race with name {race_name} "
         f"and category {category}."
     )
 
-    user = await get_user(telegram_id)
+    user = get_user.sync(telegram_id)
+    race = get_upcoming_race_by_name.sync(race_name)
 
-    participant_info = {
-        "telegram_id": telegram_id,
-        "category": category,
-        "race_number": 0,
-    }
+    if not (user and race):
+        logger.warning(
+            f"Can't find either user with telegram id {telegram_id} or race with name {race_name}."
+        )
+        return False
+
+    # Upsert is atomic, so concurrent registrations can't overwrite each other.
+    try:
+        result = registration_query(race, telegram_id).update_one(
+            upsert=True,
+            set_on_insert__category=category,
+            set_on_insert__race_number=0,
+            full_result=True,
+        )
+        registered = result.upserted_id is not None
+    except NotUniqueError:
+        registered = False
 
-    logger.debug(f"Prepared participant info: {participant_info}.")
+    if not registered:
+        logger.debug(
+            f"User with telegram id {telegram_id} is already registered for race with name {race_name}."
+        )
+        return True
 
-    race = await get_upcoming_race_by_name(race_name)
+    logger.debug(
+        f"Successfully registered user with telegram id {telegram_id} for race with name {race_name}. "
+        f"in category {category}."
+    )
 
-    if user and race:
-        race.participants.append(user)
-        race.participants_infos.append(participant_info)
-        race.save()
+    full_name = f"{user.last_name} {user.first_name}"
 
-        logger.debug(
-            f"Successfully registered user with telegram id {telegram_id} for race with name {race_name}. "
-            f"in category {category}."
-        )
+    new_payment.sync(telegram_id, full_name, race, race.price)
 
-        full_name = f"{user.last_name} {user.first_name}"
+    return True
 
-        await new_payment(telegram_id, full_name, race, race.price)
 
-        res = True
-    else:
-        logger.warning(
-            f"Can't find either user with telegram id {telegram_id} or race with name {race_name}."
-        )
-        res = False
-    return res
+@threaded
+def end_race(race):
+    logger.info(f"Marking race with name {race.name} as ended.")
+
+    race.update(ended=True)
+
 
+@threaded
+def update_price(race, price):
+    logger.info(f"Changing price of race with name {race.name} to {price}.")
 
-async def open_registration(race):
+    race.update(price=price)
+
+
+@threaded
+def open_registration(race):
     logger.info(f"Trying to open race with name {race.name}.")
 
     race.update(registration_open=True)
     race.save()
 
 
-async def close_registration(race):
+@threaded
+def close_registration(race):
     logger.info(f"Trying to close race with name {race.name}.")
 
     race.update(registration_open=False)
-    race.save()
 
     categories = race.categories
-    participant_infos = race.participants_infos
+    registrations = list(registrations_query(race))
 
     logger.info(
-        f"Race has {len(categories)} categories and {len(participant_infos)} participants."
+        f"Race has {len(categories)} categories and {len(registrations)} participants."
     )
     race_number_data = defaultdict(list)
+    updates = []
     category_prefix = 1
     for category in categories:
         participant_number = 1
-        participants_by_category = [
-            participant
-            for participant in participant_infos
-            if participant["category"] == category
+        registrations_by_category = [
+            registration
+            for registration in registrations
+            if registration.category == category
         ]
-        for participant in participants_by_category:
+        for registration in registrations_by_category:
             race_number = f"{category_prefix}{str(participant_number).zfill(2)}"
-            participant["race_number"] = int(race_number)
+            updates.append(
+                UpdateOne(
+                    {"_id": registration.id},
+                    {"$set": {"race_number": int(race_number)}},
+                )
+            )
             participant_number += 1
             race_number_data[category].append(race_number)
         category_prefix += 1
 
-    race.save()
+    if updates:
+        Registration._get_collection().bulk_write(updates, ordered=False)
 
     logger.info(
         f"Closed registration and generate race numbers for {len(race_number_data)} categories."
@@ -351,33 +597,24 @@ async def close_registration(race):
     return race_number_data
 
 
-async def create_participants_table(race):
-    participants = race.participants
-    participants_infos = race.participants_infos
-
-    table_entries = []
-    for participant, participant_info in zip(participants, participants_infos):
-        entry = {
-            "Номер": participant_info["race_number"],
-            "Пол": participant.gender,
-            "Дата рождения": participant.birthday.strftime("%d.%m.%Y"),
-            "Категория": participant_info["category"],
-            "Полное имя": f"{participant.last_name} {participant.first_name}",
-            "Telegram ID": participant.telegram_id,
-            "Телефон": participant.phone,
-            "Email": participant.email,
-        }
-        table_entries.append(entry)
-
-    table_entries = sorted(table_entries, key=lambda x: x["Номер"])
-
-    df = pd.DataFrame(table_entries)
-    os.makedirs(g.TMP_DIR, exist_ok=True)
-    excel_path = os.path.join(g.TMP_DIR, "participants.xlsx")
-
-    df.to_excel(excel_path, index=False)
+@threaded
+def create_participants_table(race) -> BinaryIO:
+    """Returns temporary XLSX file with participants sorted by race number."""
+    rows = (
+        [
+            registration.race_number,
+            participant.gender,
+            participant.birthday.strftime("%d.%m.%Y"),
+            registration.category,
+            f"{participant.last_name} {participant.first_name}",
+            participant.telegram_id,
+            participant.phone,
+            participant.email,
+        ]
+        for registration, participant in iter_participants(race, "race_number")
+    )
 
-    return excel_path
+    return export.write_xlsx(PARTICIPANTS_COLUMNS, rows)
 
 
 def get_day(dt: str = None):
@@ -398,12 +635,12 @@ def get_day(dt: str = None):
     return day
 
 
-# @crontab("0 1 * * *")
-async def backup():
+@threaded
+def backup():
     collection_names = sorted(
         cinfo.get_database(g.AppState.DataBase.db).list_collection_names()
     )
-    collections = [Payment, Race, User]
+    collections = [Payment, Race, Registration, Telemetry, User]
 
     if not len(collection_names) == len(collections):
         logger.error(
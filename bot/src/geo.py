@@ -0,0 +1,416 @@
+import os
+import shutil
+
+import numpy as np
+
+# Mean Earth radius in meters.
+EARTH_RADIUS = 6371008.8
+
+# Max number of (rider, segment) pairs evaluated at once during the full scan.
+SCAN_CHUNK_SIZE = 500_000
+
+# Size of the spatial index grid cell in meters. Riders matched farther than one
+# cell away from the track fall back to the full scan.
+GRID_CELL_SIZE = 250.0
+
+# Progress window around the last accepted position of a rider, in meters. The
+# window ahead grows with time passed since the last update at MAX_SPEED (m/s).
+WINDOW_BEHIND = 500.0
+WINDOW_AHEAD = 2000.0
+MAX_SPEED = 25.0
+
+# If the best match inside of the window is farther than this (meters) and the
+# whole track has a much closer match, the rider is re-acquired globally.
+REACQUIRE_DISTANCE = 500.0
+
+# Version of the compiled track layout, bumped on incompatible changes.
+TRACK_FORMAT = 1
+
+# Arrays of the compiled track, every one is stored as <name>.npy.
+TRACK_ARRAYS = [
+    "points",
+    "xy",
+    "lengths",
+    "cumulative",
+    "bearings",
+    "seg_delta",
+    "seg_inverse",
+    "cell_keys",
+    "cell_starts",
+    "cell_segments",
+]
+
+# Multiplier used to pack (column, row) of a grid cell into a single int64 key.
+GRID_KEY_BASE = 1 << 32
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Returns great-circle distance in meters, works on scalars and arrays."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """Returns initial bearing in degrees from north, works on scalars and arrays."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+
+    x = np.sin(lon2 - lon1) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def expand_ranges(owners, starts, ends):
+    """Expands [start, end) ranges into flat (owner, position) pairs."""
+    counts = ends - starts
+    total = counts.sum()
+
+    pair_owner = np.repeat(owners, counts)
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return pair_owner, offsets + np.arange(total)
+
+
+def nearest(owner, squared, count):
+    """Returns index of the closest pair for every owner and mask of owners found."""
+    best = np.full(count, -1, dtype=np.int64)
+    if not len(owner):
+        return best, best >= 0
+
+    order = np.lexsort((squared, owner))
+    owner = owner[order]
+    first = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+
+    best[owner[first]] = order[first]
+    return best, best >= 0
+
+
+class GridIndex:
+    """Uniform grid over segment bounding boxes stored as sorted cell keys.
+
+    Segments of every cell are stored contiguously in cell_segments, the slice
+    for cell_keys[i] is cell_segments[cell_starts[i]:cell_starts[i + 1]].
+    """
+
+    def __init__(self, cell_keys, cell_starts, cell_segments, cell_size):
+        self.cell_keys = cell_keys
+        self.cell_starts = cell_starts
+        self.cell_segments = cell_segments
+        self.cell_size = float(cell_size)
+
+    @classmethod
+    def build(cls, seg_start, seg_end, cell_size=GRID_CELL_SIZE):
+        low = np.floor(np.minimum(seg_start, seg_end) / cell_size).astype(np.int64)
+        high = np.floor(np.maximum(seg_start, seg_end) / cell_size).astype(np.int64)
+
+        columns = high[:, 0] - low[:, 0] + 1
+        rows = high[:, 1] - low[:, 1] + 1
+        counts = columns * rows
+
+        segments = np.arange(len(seg_start))
+        owner, position = expand_ranges(segments, np.zeros_like(counts), counts)
+
+        column = low[owner, 0] + position // rows[owner]
+        row = low[owner, 1] + position % rows[owner]
+        keys = column * GRID_KEY_BASE + row
+
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+
+        cell_keys, cell_starts = np.unique(keys, return_index=True)
+        cell_starts = np.append(cell_starts, len(keys))
+
+        return cls(cell_keys, cell_starts, owner[order], cell_size)
+
+    def candidates(self, xy):
+        """Returns (point, segment) pairs from the 3x3 cell block around every point."""
+        cell = np.floor(xy / self.cell_size).astype(np.int64)
+        shifts = np.arange(-1, 2)
+
+        columns = cell[:, 0, None, None] + shifts[None, :, None]
+        rows = cell[:, 1, None, None] + shifts[None, None, :]
+        keys = (columns * GRID_KEY_BASE + rows).reshape(len(xy), -1)
+
+        position = np.searchsorted(self.cell_keys, keys)
+        position = np.minimum(position, len(self.cell_keys) - 1)
+        found = self.cell_keys[position] == keys
+
+        starts = np.where(found, self.cell_starts[position], 0)
+        ends = np.where(found, self.cell_starts[position + 1], 0)
+        owners = np.repeat(np.arange(len(xy)), keys.shape[1])
+
+        owner, index = expand_ranges(owners, starts.ravel(), ends.ravel())
+        return owner, self.cell_segments[index]
+
+
+class Track:
+    """Track geometry with precomputed cumulative distance of every vertex.
+
+    Riders are projected onto the nearest segment in a local ENU plane centered
+    on the track, while segment lengths are measured with haversine.
+    """
+
+    def __init__(self, points, cell_size=GRID_CELL_SIZE):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if not len(self.points):
+            raise ValueError("Track must contain at least one point.")
+
+        self.origin = self.points.mean(axis=0)
+        self.xy = self.to_xy(self.points)
+
+        lat, lon = self.points[:, 0], self.points[:, 1]
+        self.lengths = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        self.cumulative = np.concatenate(([0.0], np.cumsum(self.lengths)))
+
+        self.bearings = bearing(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+        self._prepare_segments()
+
+        self.index = GridIndex.build(
+            self.seg_start, self.seg_start + self.seg_delta, cell_size
+        )
+
+    def _prepare_segments(self):
+        # Degenerate one-point track is treated as a single zero-length segment.
+        xy = self.xy if len(self.xy) > 1 else np.repeat(self.xy, 2, axis=0)
+        if not len(self.lengths):
+            self.lengths = np.zeros(1)
+            self.bearings = np.zeros(1)
+            self.cumulative = np.zeros(2)
+
+        self.seg_start = xy[:-1]
+        self.seg_delta = xy[1:] - xy[:-1]
+
+        squared = (self.seg_delta**2).sum(axis=1)
+        self.seg_inverse = np.divide(
+            1.0, squared, out=np.zeros_like(squared), where=squared > 0
+        )
+
+    def save(self, path):
+        """Writes compiled track into the directory, replacing the previous one."""
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        arrays = {
+            "cell_keys": self.index.cell_keys,
+            "cell_starts": self.index.cell_starts,
+            "cell_segments": self.index.cell_segments,
+        }
+        for name in TRACK_ARRAYS:
+            array = arrays.get(name, getattr(self, name, None))
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(array))
+
+        meta = np.array([TRACK_FORMAT, *self.origin, self.index.cell_size])
+        np.save(os.path.join(tmp_path, "meta.npy"), meta)
+
+        # Directories can't be atomically replaced, so the old one is moved away
+        # first and removed only after the new one is in place.
+        old_path = f"{path}.old"
+        if os.path.isdir(path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Opens compiled track from the directory, arrays are memory-mapped."""
+        meta = np.load(os.path.join(path, "meta.npy"))
+        if int(meta[0]) != TRACK_FORMAT:
+            raise ValueError(f"Unsupported compiled track format {meta[0]} in {path}.")
+
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in TRACK_ARRAYS
+        }
+
+        track = cls.__new__(cls)
+        track.origin = meta[1:3]
+        for name in ["points", "xy", "lengths", "cumulative", "bearings"]:
+            setattr(track, name, arrays[name])
+
+        xy = track.xy if len(track.xy) > 1 else np.repeat(track.xy, 2, axis=0)
+        track.seg_start = xy[:-1]
+        track.seg_delta = arrays["seg_delta"]
+        track.seg_inverse = arrays["seg_inverse"]
+
+        track.index = GridIndex(
+            arrays["cell_keys"], arrays["cell_starts"], arrays["cell_segments"], meta[3]
+        )
+        return track
+
+    @property
+    def length(self):
+        """Total track length in meters."""
+        return self.cumulative[-1]
+
+    @property
+    def segments(self):
+        return len(self.seg_start)
+
+    def to_xy(self, coordinates):
+        """Converts [[lat, lon], ...] to local east/north coordinates in meters."""
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        lat0, lon0 = np.radians(self.origin)
+        lat, lon = np.radians(coordinates[:, 0]), np.radians(coordinates[:, 1])
+
+        x = (lon - lon0) * np.cos(lat0) * EARTH_RADIUS
+        y = (lat - lat0) * EARTH_RADIUS
+        return np.column_stack((x, y))
+
+    def _distances(self, x, y, segments):
+        """Returns position along segments (0..1) and squared distance to them.
+
+        Arguments are broadcast against each other, so the same code serves both
+        the (riders, segments) grid of the full scan and flat candidate pairs.
+        """
+        dx = x - self.seg_start[segments, 0]
+        dy = y - self.seg_start[segments, 1]
+        sx = self.seg_delta[segments, 0]
+        sy = self.seg_delta[segments, 1]
+
+        t = np.clip((dx * sx + dy * sy) * self.seg_inverse[segments], 0.0, 1.0)
+
+        ex = dx - t * sx
+        ey = dy - t * sy
+        return t, ex * ex + ey * ey
+
+    def _progress(self, segments, t):
+        return self.cumulative[segments] + t * self.lengths[segments]
+
+    def scan(self, xy):
+        """Checks every segment for every point, returns (segment, t, squared offset)."""
+        count = len(xy)
+        segment = np.empty(count, dtype=np.int64)
+        t = np.empty(count)
+        squared = np.empty(count)
+
+        all_segments = np.arange(self.segments)
+        chunk = max(1, SCAN_CHUNK_SIZE // self.segments)
+
+        for start in range(0, count, chunk):
+            end = min(start + chunk, count)
+            x = xy[start:end, 0, None]
+            y = xy[start:end, 1, None]
+
+            grid_t, grid_squared = self._distances(x, y, all_segments)
+            closest = grid_squared.argmin(axis=1)
+            rows = np.arange(end - start)
+
+            segment[start:end] = closest
+            t[start:end] = grid_t[rows, closest]
+            squared[start:end] = grid_squared[rows, closest]
+
+        return segment, t, squared
+
+    def lookup(self, xy):
+        """Finds nearest segments through the grid index, returns (segment, t,
+        squared offset) and mask of points which were resolved by the index.
+
+        Result is exact for a point only if the match is within one cell, so
+        the nearest segment is guaranteed to be among the 3x3 candidate cells.
+        """
+        owner, candidates = self.index.candidates(xy)
+        pair_t, pair_squared = self._distances(xy[owner, 0], xy[owner, 1], candidates)
+
+        best, found = nearest(owner, pair_squared, len(xy))
+        return self._pick(best, found, candidates, pair_t, pair_squared)
+
+    def _pick(self, best, found, candidates, pair_t, pair_squared):
+        """Collects matched pairs, keeping only matches closer than one grid cell."""
+        segment = np.zeros(len(best), dtype=np.int64)
+        t = np.zeros(len(best))
+        squared = np.full(len(best), np.inf)
+
+        segment[found] = candidates[best[found]]
+        t[found] = pair_t[best[found]]
+        squared[found] = pair_squared[best[found]]
+
+        return segment, t, squared, squared <= self.index.cell_size**2
+
+    def project(self, coordinates):
+        """Projects a batch of [[lat, lon], ...] onto the nearest track segments.
+
+        Returns progress along the track (meters), perpendicular offset from the
+        track (meters) and the index of the matched segment for every point.
+        """
+        xy = self.to_xy(coordinates)
+        if not len(xy):
+            return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+
+        segment, t, squared, found = self.lookup(xy)
+
+        missed = ~found
+        if missed.any():
+            # Riders far off course are not covered by the index.
+            scanned = self.scan(xy[missed])
+            segment[missed], t[missed], squared[missed] = scanned
+
+        return self._progress(segment, t), np.sqrt(squared), segment
+
+    def window_scan(self, xy, low, high):
+        """Checks all segments overlapping [low, high] progress range of every point."""
+        first = np.searchsorted(self.cumulative, low, side="right") - 1
+        last = np.searchsorted(self.cumulative, high, side="left")
+
+        first = np.clip(first, 0, self.segments - 1)
+        last = np.clip(last, first + 1, self.segments)
+
+        owner, candidates = expand_ranges(np.arange(len(xy)), first, last)
+        pair_t, pair_squared = self._distances(xy[owner, 0], xy[owner, 1], candidates)
+
+        best, _ = nearest(owner, pair_squared, len(xy))
+        return candidates[best], pair_t[best], pair_squared[best]
+
+    def follow(self, coordinates, previous, elapsed):
+        """Projects riders only onto the part of the track near their last progress.
+
+        On courses which overlap themselves (laps, out-and-back) the nearest
+        segment may belong to another pass, so the search is limited to a window
+        of progress, which also keeps every update local. Returned progress never
+        decreases, previous and elapsed are in meters and seconds per rider.
+        """
+        xy = self.to_xy(coordinates)
+        if not len(xy):
+            return np.empty(0), np.empty(0)
+
+        previous = np.asarray(previous, dtype=np.float64)
+        low = previous - WINDOW_BEHIND
+        high = previous + WINDOW_AHEAD + np.asarray(elapsed) * MAX_SPEED
+
+        owner, candidates = self.index.candidates(xy)
+        inside = (self.cumulative[candidates + 1] >= low[owner]) & (
+            self.cumulative[candidates] <= high[owner]
+        )
+        owner, candidates = owner[inside], candidates[inside]
+
+        pair_t, pair_squared = self._distances(xy[owner, 0], xy[owner, 1], candidates)
+        best, found = nearest(owner, pair_squared, len(xy))
+        segment, t, squared, found = self._pick(
+            best, found, candidates, pair_t, pair_squared
+        )
+
+        missed = ~found
+        if missed.any():
+            scanned = self.window_scan(xy[missed], low[missed], high[missed])
+            segment[missed], t[missed], squared[missed] = scanned
+
+        progress = self._progress(segment, t)
+        offsets = np.sqrt(squared)
+
+        lost = offsets > REACQUIRE_DISTANCE
+        if lost.any():
+            global_progress, global_offsets, _ = self.project(
+                np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)[lost]
+            )
+            closer = global_offsets * 2 < offsets[lost]
+
+            reacquired = np.flatnonzero(lost)[closer]
+            progress[reacquired] = global_progress[closer]
+            offsets[reacquired] = global_offsets[closer]
+
+        return np.maximum(progress, previous), offsets
@@ -6,6 +6,10 @@ from pytz import timezone
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+from history import RaceHistory
+from leaderboard import Leaderboard, LeaderboardFeed
+from roster import Roster
+
 
 CURRENT_PATH = os.path.dirname(os.path.realpath(__file__))
 WORKSPACE_PATH = os.path.dirname(CURRENT_PATH)
@@ -26,6 +30,10 @@ MAP_DIR = os.path.join(WORKSPACE_PATH, "map")
 os.makedirs(MAP_DIR, exist_ok=True)
 MAP_PATH = os.path.join(MAP_DIR, "map.html")
 
+SNAPSHOT_DIR = os.path.join(WORKSPACE_PATH, "snapshot")
+os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+SNAPSHOT_PATH = os.path.join(SNAPSHOT_DIR, "race.json")
+
 # Chat IDs with volunteers and staff.
 TEAM_CHAT_ID = "-937192524"
 
@@ -44,8 +52,6 @@ async def get_time_shift():
 # Difference between time on host in comparsion to local time.
 HOUR_SHIFT = None
 
-# How often the map should be updated.
-MAP_TICKRATE = "*/1 * * * *"
 
 # Paths to the env files.
 # * Important: if the dev.env file exists, the app will run in dev mode.
@@ -108,6 +114,23 @@ class State:
             self.info = None
             self.ongoing = False
             self.location_data = {}
+            # Participants by telegram id and race number, built at race start.
+            self.roster = Roster()
+            # Last accepted progress along the track in meters, epoch time of
+            # the update and filtered speed in m/s for every rider, keyed by
+            # telegram id.
+            self.progress = {}
+            # Telegram ids of riders whose last position is too far from the track.
+            self.off_course = set()
+            # Telegram ids of riders whose coordinates changed since the last tick.
+            self.dirty = set()
+            self.ranking = Leaderboard()
+            self.feed = LeaderboardFeed()
+            self.history = RaceHistory()
+            # Static map with the track is sent once per race, and again if
+            # it was not accepted or the webserver lost it.
+            self.map_published = False
+            self.map_sending = False
             self.leaderboard = []
             self.start_time = None
             self.finishers = []
@@ -127,6 +150,9 @@ class State:
 logger = Logger(__name__)
 AppState = State()
 
+# Minimal interval in seconds between map and leaderboard updates.
+MAP_UPDATE_INTERVAL = int(os.getenv("MAP_UPDATE_INTERVAL", 5))
+
 # Credentials for payments message.
 SBP_PHONE = os.getenv("SBP_PHONE")
 SBP_BANKS = os.getenv("SBP_BANKS")
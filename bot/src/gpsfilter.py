@@ -0,0 +1,53 @@
+import numpy as np
+
+import geo
+
+# Distance in meters from the track after which a position is treated as off course.
+OFF_COURSE_DISTANCE = 200.0
+
+# Gains of the alpha-beta filter for progress and speed along the track.
+ALPHA = 0.6
+BETA = 0.1
+
+
+def filter_progress(
+    measured: np.ndarray,
+    offsets: np.ndarray,
+    previous: np.ndarray,
+    velocity: np.ndarray,
+    elapsed: np.ndarray,
+    known: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Rejects implausible positions and smooths progress of riders.
+
+    Measured progress and offsets from the track are in meters, velocity in m/s
+    and elapsed in seconds since the last accepted position, known is False for
+    riders without accepted positions yet. Position is rejected if it's off
+    course or implies speed above geo.MAX_SPEED, accepted ones are smoothed with
+    an alpha-beta filter. Returns progress, velocity, accepted and off course
+    masks, all computed for every rider at once.
+    """
+    measured = np.asarray(measured, dtype=np.float64)
+    previous = np.asarray(previous, dtype=np.float64)
+    velocity = np.asarray(velocity, dtype=np.float64)
+    known = np.asarray(known, dtype=bool)
+    elapsed = np.maximum(np.asarray(elapsed, dtype=np.float64), 1)
+
+    off_course = np.asarray(offsets) > OFF_COURSE_DISTANCE
+    plausible = (measured - previous) / elapsed <= geo.MAX_SPEED
+    accepted = ~off_course & plausible
+
+    predicted = previous + velocity * elapsed
+    residual = measured - predicted
+
+    smoothed = np.where(known, predicted + ALPHA * residual, measured)
+    # Smoothed progress can't go backwards or overshoot the measurement.
+    smoothed = np.clip(smoothed, previous, np.maximum(measured, previous))
+
+    smoothed_velocity = np.where(known, velocity + BETA * residual / elapsed, 0)
+    smoothed_velocity = np.clip(smoothed_velocity, 0, geo.MAX_SPEED)
+
+    progress = np.where(accepted, smoothed, previous)
+    velocity = np.where(accepted, smoothed_velocity, velocity)
+
+    return progress, velocity, accepted, off_course
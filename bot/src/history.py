@@ -0,0 +1,153 @@
+import math
+
+import numpy as np
+
+# Number of latest updates kept for every rider, one hour with 5 seconds interval.
+HISTORY_SIZE = 720
+
+# Seconds of history used to calculate current speed of a rider.
+SPEED_WINDOW = 300
+
+# Distance in meters between split points along the track, which are used to
+# calculate time gaps between riders.
+SPLIT_DISTANCE = 500
+
+# Speed in m/s below which rider is considered stopped and ETA is not shown.
+MIN_SPEED = 0.5
+
+
+class RiderHistory:
+    """Latest updates of a single rider stored in fixed-size ring buffers.
+
+    Besides the latest updates, epoch time of passing every split point along
+    the track is kept for the whole race, so time gaps don't depend on the
+    size of the ring buffer.
+    """
+
+    def __init__(self, size: int, splits: int):
+        self.times = np.zeros(size, dtype=np.float64)
+        self.progress = np.zeros(size, dtype=np.float32)
+        self.coordinates = np.zeros((size, 2), dtype=np.float32)
+        self.head = 0
+        self.count = 0
+
+        self.splits = np.full(splits, np.nan)
+        self.passed = 0
+
+    def append(self, timestamp: float, progress: float, coordinates: list[float]):
+        if self.count:
+            last = (self.head - 1) % len(self.times)
+            last_time, last_progress = self.times[last], float(self.progress[last])
+            if timestamp <= last_time:
+                return
+            self.record_splits(last_time, last_progress, timestamp, progress)
+        else:
+            # Splits passed before the first update are unknown and stay NaN.
+            self.passed = min(int(progress // SPLIT_DISTANCE), len(self.splits))
+
+        self.times[self.head] = timestamp
+        self.progress[self.head] = progress
+        self.coordinates[self.head] = coordinates
+        self.head = (self.head + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def record_splits(
+        self, last_time: float, last_progress: float, timestamp: float, progress: float
+    ):
+        passed = min(int(progress // SPLIT_DISTANCE), len(self.splits))
+        if passed <= self.passed:
+            return
+
+        # Split time is interpolated between the two updates around it.
+        marks = np.arange(self.passed + 1, passed + 1) * SPLIT_DISTANCE
+        self.splits[self.passed : passed] = np.interp(
+            marks, [last_progress, progress], [last_time, timestamp]
+        )
+        self.passed = passed
+
+    def latest(self) -> tuple[np.ndarray, np.ndarray]:
+        """Returns times and progress of the latest updates, oldest first."""
+        order = (self.head - self.count + np.arange(self.count)) % len(self.times)
+        return self.times[order], self.progress[order]
+
+    def speed(self, window: float = SPEED_WINDOW) -> float | None:
+        """Returns average speed in m/s for the last window seconds."""
+        times, progress = self.latest()
+        if len(times) < 2:
+            return
+
+        first = np.searchsorted(times, times[-1] - window)
+        first = min(first, len(times) - 2)
+
+        elapsed = times[-1] - times[first]
+        if elapsed <= 0:
+            return
+
+        return float(progress[-1] - progress[first]) / elapsed
+
+
+class RaceHistory:
+    """Position history of all riders of the race, keyed by telegram id.
+
+    Memory is bounded by the number of riders, the ring buffer size and the
+    number of splits, which is about 20 KB per rider for a 100 km race.
+    """
+
+    def __init__(self, distance: float = 0, size: int = HISTORY_SIZE):
+        # Race distance is stored in km in the database.
+        self.distance = distance * 1000
+        self.size = size
+        self.splits = max(math.ceil(self.distance / SPLIT_DISTANCE), 1)
+        self.riders = {}
+
+    def record(
+        self,
+        telegram_id: int,
+        timestamp: float,
+        progress: float,
+        coordinates: list[float],
+    ):
+        rider = self.riders.get(telegram_id)
+        if rider is None:
+            rider = self.riders[telegram_id] = RiderHistory(self.size, self.splits)
+
+        rider.append(timestamp, progress, coordinates)
+
+    def remove(self, telegram_id: int):
+        self.riders.pop(telegram_id, None)
+
+    def speed(self, telegram_id: int) -> float | None:
+        rider = self.riders.get(telegram_id)
+        if rider:
+            return rider.speed()
+
+    def eta(self, telegram_id: int) -> float | None:
+        """Returns estimated seconds to the finish at the current speed."""
+        rider = self.riders.get(telegram_id)
+        if not rider or not self.distance:
+            return
+
+        speed = rider.speed()
+        if speed is None or speed < MIN_SPEED:
+            return
+
+        _, progress = rider.latest()
+        return max(self.distance - float(progress[-1]), 0) / speed
+
+    def gap(self, telegram_id: int, leader_id: int) -> float | None:
+        """Returns seconds between the leader and the rider at the last split
+        point passed by the rider."""
+        rider = self.riders.get(telegram_id)
+        leader = self.riders.get(leader_id)
+        if not rider or not leader or not rider.passed:
+            return
+
+        split = rider.passed - 1
+        if split >= leader.passed:
+            return
+
+        gap = rider.splits[split] - leader.splits[split]
+        if np.isnan(gap):
+            return
+
+        return float(gap)
@@ -0,0 +1,91 @@
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    """Riders ordered by distance along the track, longest distance first.
+
+    Both updating a rider and getting rank of a rider cost O(log n), so only
+    riders whose position has changed need to be touched on every tick.
+    """
+
+    def __init__(self):
+        self.order = SortedList()
+        self.keys = {}
+
+    def update(self, telegram_id: int, distance: float):
+        self.remove(telegram_id)
+
+        key = (-distance, telegram_id)
+        self.keys[telegram_id] = key
+        self.order.add(key)
+
+    def remove(self, telegram_id: int):
+        key = self.keys.pop(telegram_id, None)
+        if key:
+            self.order.remove(key)
+
+    def rank(self, telegram_id: int) -> int | None:
+        key = self.keys.get(telegram_id)
+        if key:
+            return self.order.index(key) + 1
+
+    def distance(self, telegram_id: int) -> float | None:
+        key = self.keys.get(telegram_id)
+        if key:
+            return -key[0]
+
+    def __iter__(self):
+        for distance, telegram_id in self.order:
+            yield telegram_id, -distance
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, telegram_id: int):
+        return telegram_id in self.keys
+
+
+class LeaderboardFeed:
+    """Encodes leaderboard for the webserver as versioned deltas.
+
+    Every message has a version, a delta also has the base version it applies
+    to and contains only rows whose position changed since the previous message.
+    Full snapshot is sent every snapshot_every versions and after the webserver
+    reports a version mismatch.
+    """
+
+    def __init__(self, snapshot_every: int = 30):
+        self.snapshot_every = snapshot_every
+        self.version = 0
+        self.rows = []
+        self.resync = True
+
+    def message(self, leaderboard: list[dict]) -> dict | None:
+        """Returns message for the new leaderboard or None if nothing changed."""
+        if not self.resync and leaderboard == self.rows:
+            return
+
+        self.version += 1
+
+        if self.resync or self.version % self.snapshot_every == 0:
+            message = {"version": self.version, "full": True, "rows": leaderboard}
+            self.resync = False
+        else:
+            changed = [
+                row
+                for idx, row in enumerate(leaderboard)
+                if idx >= len(self.rows) or self.rows[idx] != row
+            ]
+            message = {
+                "version": self.version,
+                "base": self.version - 1,
+                "size": len(leaderboard),
+                "rows": changed,
+            }
+
+        self.rows = leaderboard
+        return message
+
+    def on_response(self, status: int, text: str):
+        if status == 409:
+            self.resync = True
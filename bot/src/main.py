@@ -1,14 +1,10 @@
 import asyncio
 import secrets
-import os
 
 from datetime import datetime, timedelta
 from re import escape, match
 from collections import defaultdict
 
-import pandas as pd
-
-
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.dispatcher.filters import Text
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -16,8 +12,14 @@ from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
 import globals as g
 import database as db
+import export
 import track as tr
+import registry
+import snapshot
+import telemetry
 from templates import Buttons, Messages
+from history import RaceHistory
+from leaderboard import Leaderboard, LeaderboardFeed
 
 
 logger = g.Logger(__name__)
@@ -25,6 +27,8 @@ logger = g.Logger(__name__)
 bot = Bot(token=g.AppState.Bot.token)
 dp = Dispatcher(bot=bot)
 
+FINISHERS_COLUMNS = ["Номер", "Время", "Категория", "Полное имя"]
+
 # region # ? commands
 
 
@@ -520,28 +524,33 @@ async def button_your_status(message):
         )
         return
 
-    race = g.AppState.Race.info
-
-    try:
-        category, race_number = db.get_participant_info(race, message.from_user.id)
-    except Exception:
-        await bot.send_message(
-            message.from_user.id, "Бот не смог найти вас среди участников гонки."
-        )
-        return
-
-    leaders = g.AppState.Race.leaderboard
-
-    for leader in leaders:
-        if leader["race_number"] == race_number:
-            position = leader["row_number"]
-            break
+    telegram_id = message.from_user.id
+    position = g.AppState.Race.ranking.rank(telegram_id)
 
     if position:
         reply = f"Ваша абсолютная позиция в гонке: {position}"
     else:
         reply = "Ваша позиция в гонке: не определена"
 
+    if telegram_id in g.AppState.Race.off_course:
+        reply += "\nПохоже, вы находитесь вне трассы."
+
+    history = g.AppState.Race.history
+
+    speed = history.speed(telegram_id)
+    if speed is not None:
+        reply += f"\nСредняя скорость за последние минуты: {speed * 3.6:.1f} км/ч"
+
+    if position and position > 1:
+        leader_id = next(iter(g.AppState.Race.ranking))[0]
+        gap = history.gap(telegram_id, leader_id)
+        if gap is not None:
+            reply += f"\nОтставание от лидера: {format_duration(gap)}"
+
+    eta = history.eta(telegram_id)
+    if eta is not None:
+        reply += f"\nОжидаемое время до финиша: {format_duration(eta)}"
+
     await bot.send_message(message.from_user.id, reply)
 
 
@@ -571,7 +580,7 @@ async def callback_race_info(callback_query):
 
     if not user:
         buttons = {secrets.token_hex(10): "⚠️ Зарегистрируйтесь в боте"}
-    elif user in race.participants:
+    elif await db.get_registration(race, user.telegram_id):
         payment = await db.get_payment(callback_query.from_user.id, race)
 
         if not payment:
@@ -647,7 +656,7 @@ async def callback_race_register(callback_query):
     race = await db.get_upcoming_race_by_name(race_name)
     user = await db.get_user(callback_query.from_user.id)
 
-    if user in race.participants:
+    if user and await db.get_registration(race, user.telegram_id):
         logger.debug(
             f"User with telegram ID {callback_query.from_user.id} already registered to race {race.name}!"
         )
@@ -704,7 +713,7 @@ async def button_translation(message):
         await bot.send_message(message.from_user.id, Messages.ONLY_FOR_REGISTERED.value)
         return
 
-    if user not in race.participants:
+    if not await db.get_registration(race, user.telegram_id):
         await bot.send_message(
             message.from_user.id, Messages.ONLY_FOR_PARTICIPANTS.value
         )
@@ -785,27 +794,14 @@ async def translation(message):
             f"User {message.from_user.id} is not in location_data, will create it."
         )
 
-        user = await db.get_user(message.from_user.id)
-        if not user:
+        participant = g.AppState.Race.roster.get(message.from_user.id)
+        if not participant:
             logger.warning(
-                f"Can't find the user with telegram id {message.from_user.id} in database."
+                f"Can't find the user with telegram id {message.from_user.id} in participants list."
             )
             return
 
-        try:
-            category, race_number = await db.get_participant_info(
-                race, message.from_user.id
-            )
-            logger.debug(
-                f"Found category {category} and race number {race_number} for user with "
-                f"telegram id {message.from_user.id}."
-            )
-
-        except Exception:
-            logger.warning(
-                f"Can't find the user {user.first_name} {user.last_name} in participants list."
-            )
-            return
+        race_number = participant["race_number"]
 
         if await is_finished(race_number):
             logger.debug(
@@ -814,13 +810,15 @@ async def translation(message):
             return
 
         user_info = {
-            "full_name": f"{user.last_name} {user.first_name}",
-            "category": category,
+            "full_name": participant["full_name"],
+            "category": participant["category"],
             "race_number": race_number,
             "coordinates": coordinates,
         }
 
         g.AppState.Race.location_data[message.from_user.id] = user_info
+        tr.notify_location(message.from_user.id)
+        telemetry.WRITER.add(race, message.from_user.id, coordinates)
 
         logger.debug(f"User info saved in global state: {user_info}.")
     else:
@@ -838,6 +836,8 @@ async def translation(message):
         )
 
         g.AppState.Race.location_data[message.from_user.id]["coordinates"] = coordinates
+        tr.notify_location(message.from_user.id)
+        telemetry.WRITER.add(race, message.from_user.id, coordinates)
 
 
 ################################
@@ -1055,14 +1055,31 @@ async def callback_race_start_init(callback_query):
         return
 
     race = await db.get_race_by_date()
+    roster = await db.get_roster(race)
 
     g.AppState.Race.info = race
+    g.AppState.Race.roster = roster
     g.AppState.Race.ongoing = True
+    g.AppState.Race.progress = {}
+    g.AppState.Race.off_course = set()
+    g.AppState.Race.dirty = set()
+    g.AppState.Race.ranking = Leaderboard()
+    g.AppState.Race.feed = LeaderboardFeed()
+    g.AppState.Race.history = RaceHistory(race.distance)
+    g.AppState.Race.map_published = False
+    g.AppState.Race.map_sending = False
+    for telegram_id in g.AppState.Race.location_data:
+        tr.notify_location(telegram_id)
     start_time = int(datetime.now().timestamp())
     g.AppState.Race.start_time = start_time
 
     logger.info(f"Race with name {race.name} started at epoch time: {start_time}.")
 
+    await snapshot.save()
+
+    registry.TRACKS.retain([race.code])
+    await tr.get_track(race.code)
+
     tr.make_post("race_state", "start")
 
     await bot.send_message(
@@ -1084,9 +1101,15 @@ async def callback_race_end_init(callback_query):
         )
 
     else:
+        race = g.AppState.Race.info
+
         g.AppState.Race.ongoing = False
         g.AppState.Race.info = None
 
+        registry.TRACKS.retain([])
+        await snapshot.remove()
+        await db.end_race(race)
+
         await bot.send_message(
             callback_query.from_user.id,
             Messages.ADMIN_RACE_END.value,
@@ -1099,30 +1122,19 @@ async def callback_race_end_init(callback_query):
     if not finishers:
         return
 
-    table_entries = []
-    for finisher in finishers:
-        race_number = finisher.get("race_number")
-        race_time = str(finisher.get("race_time"))
-        entry = {"Номер": race_number, "Время": race_time}
-        try:
-            entry["Категория"] = finisher["category"]
-            entry["Полное имя"] = finisher["full_name"]
-        except KeyError:
-            pass
-        table_entries.append(entry)
-
-    df = pd.DataFrame(table_entries)
-    os.makedirs(g.TMP_DIR, exist_ok=True)
-    excel_path = os.path.join(g.TMP_DIR, "finishers.xlsx")
-    df.to_excel(excel_path, index=False)
-
-    excel_file = types.InputFile(excel_path)
-    await bot.send_document(callback_query.from_user.id, excel_file)
+    rows = (
+        [
+            finisher.get("race_number"),
+            str(finisher.get("race_time")),
+            finisher.get("category"),
+            finisher.get("full_name"),
+        ]
+        for finisher in finishers
+    )
 
-    try:
-        os.remove(excel_path)
-    except Exception:
-        pass
+    with export.write_xlsx(FINISHERS_COLUMNS, rows) as excel_table:
+        excel_file = types.InputFile(excel_table, filename="finishers.xlsx")
+        await bot.send_document(callback_query.from_user.id, excel_file)
 
 
 @dp.callback_query_handler(text_contains="race_admin_info_")
@@ -1239,15 +1251,9 @@ async def race_close_registration(callback_query):
 
     await bot.send_message(callback_query.from_user.id, reply, parse_mode="MarkdownV2")
 
-    excel_table = await db.create_participants_table(race)
-
-    excel_file = types.InputFile(excel_table)
-    await bot.send_document(callback_query.from_user.id, excel_file)
-
-    try:
-        os.remove(excel_table)
-    except Exception:
-        pass
+    with await db.create_participants_table(race) as excel_table:
+        excel_file = types.InputFile(excel_table, filename="participants.xlsx")
+        await bot.send_document(callback_query.from_user.id, excel_file)
 
 
 ################################
@@ -1304,9 +1310,7 @@ async def change_price(message):
         logger.error(f"Can't get price from {message.text}.")
         return
 
-    race = g.AppState.Bot.race_to_edit
-    race.update(price=new_price)
-    race.save()
+    await db.update_price(g.AppState.Bot.race_to_edit, new_price)
 
     dp.message_handlers.unregister(change_price)
 
@@ -1338,11 +1342,10 @@ async def timekeeping(message):
         f"race time in human readable: {race_time}."
     )
 
-    race = g.AppState.Race.info
-
-    participant_data = await db.get_participant_by_race_number(race, race_number)
+    participant = g.AppState.Race.roster.by_race_number(race_number)
+    g.AppState.Race.roster.finish(race_number)
 
-    if not participant_data:
+    if not participant:
         logger.warning(f"Can't find participant with race number: {race_number}.")
 
         race_entry = {
@@ -1357,8 +1360,8 @@ async def timekeeping(message):
             ),
         )
     else:
-        participant, category = participant_data
-        full_name = f"{participant.last_name} {participant.first_name}"
+        full_name = participant["full_name"]
+        category = participant["category"]
 
         logger.info(f"Found participant: {full_name} with race number: {race_number}.")
 
@@ -1376,18 +1379,22 @@ async def timekeeping(message):
             ),
         )
 
-        for telegram_id, user_info in g.AppState.Race.location_data.items():
-            if user_info["race_number"] == race_number:
-                g.AppState.Race.location_data.pop(telegram_id)
-                logger.info(
-                    f"User with telegram id {telegram_id} and race number {race_number} removed from location data."
-                )
-                break
+        telegram_id = participant["telegram_id"]
+        if g.AppState.Race.location_data.pop(telegram_id, None):
+            g.AppState.Race.ranking.remove(telegram_id)
+            g.AppState.Race.history.remove(telegram_id)
+            g.AppState.Race.off_course.discard(telegram_id)
+            tr.notify_location(telegram_id)
+            logger.info(
+                f"User with telegram id {telegram_id} and race number {race_number} removed from location data."
+            )
 
     g.AppState.Race.finishers.append(race_entry)
 
     logger.info(f"Added participant with race number {race_number} to finishers list.")
 
+    await snapshot.save()
+
 
 # endregion
 
@@ -1396,10 +1403,11 @@ async def timekeeping(message):
 
 
 async def is_finished(race_number):
-    return any(
-        finisher.get("race_number") == race_number
-        for finisher in g.AppState.Race.finishers
-    )
+    return g.AppState.Race.roster.is_finished(race_number)
+
+
+def format_duration(seconds: float) -> str:
+    return str(timedelta(seconds=int(seconds)))
 
 
 async def add_hour_shift(utc_time):
@@ -1471,9 +1479,20 @@ async def on_startup():
     bot_info = await bot.get_me()
     logger.info(f"Bot started. Username: {bot_info.username}, ID: {bot_info.id}.")
     g.HOUR_SHIFT = await g.get_time_shift()
+    await db.ensure_indexes()
+    await db.migrate_registrations()
+    await snapshot.restore()
+    asyncio.get_event_loop().create_task(tr.race_pipeline())
+    asyncio.get_event_loop().create_task(snapshot.snapshot_loop())
+
+
+async def on_shutdown(dispatcher):
+    logger.info("Shutting down the main module...")
+    await tr.PUBLISHER.close()
+    await telemetry.WRITER.close()
 
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     loop.run_until_complete(on_startup())
-    executor.start_polling(dp)
+    executor.start_polling(dp, on_shutdown=on_shutdown)
@@ -0,0 +1,132 @@
+import asyncio
+
+import aiohttp
+
+import globals as g
+
+logger = g.Logger(__name__)
+
+
+class Publisher:
+    """Sends POST requests to the webserver in the background.
+
+    Requests are put into a bounded queue and sent one by one with a single
+    pooled aiohttp session, so a slow webserver never blocks the bot handlers.
+    When the queue is full the oldest request is dropped, since every update
+    supersedes the previous one anyway.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: str,
+        maxsize: int = 100,
+        timeout: float = 10,
+        retries: int = 3,
+        backoff: float = 1,
+    ):
+        self.url = url
+        self.token = token
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+        self.queue = asyncio.Queue(maxsize)
+        self.session = None
+        self.task = None
+
+    def publish(
+        self,
+        request_type: str,
+        json=None,
+        data: bytes = None,
+        on_response=None,
+    ):
+        """Queues the request without waiting for it to be sent.
+
+        Either json or data (sent as multipart file) can be passed, on_response
+        is called with the status and the text of the response, or with None
+        status if the request was dropped.
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+        request = (request_type, json, data, on_response)
+
+        if self.queue.full():
+            dropped = self.queue.get_nowait()
+            self.queue.task_done()
+            logger.warning(f"Publish queue is full, dropped {dropped[0]} request.")
+            if dropped[3]:
+                dropped[3](None, None)
+
+        self.queue.put_nowait(request)
+
+    async def run(self):
+        while True:
+            request = await self.queue.get()
+            try:
+                await self.send(*request)
+            except Exception:
+                logger.exception(f"Error while sending {request[0]} request.")
+            finally:
+                self.queue.task_done()
+
+    async def send(self, request_type, json, data, on_response):
+        headers = {"post-token": self.token, "request-type": request_type}
+
+        for attempt in range(1, self.retries + 1):
+            try:
+                async with self.get_session().post(
+                    self.url, headers=headers, json=json, data=self.form(data)
+                ) as response:
+                    text = await response.text()
+
+                    if response.status < 500:
+                        logger.info(
+                            f"POST request with {request_type} sent with response "
+                            f"{response.status}: {text}"
+                        )
+                        if on_response:
+                            on_response(response.status, text)
+                        return
+
+                    logger.warning(
+                        f"POST request with {request_type} failed with status "
+                        f"{response.status}, attempt {attempt}."
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(
+                    f"Error while sending POST request with {request_type}, "
+                    f"attempt {attempt}: {repr(e)}"
+                )
+
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+        logger.error(
+            f"POST request with {request_type} dropped after {self.retries} attempts."
+        )
+        if on_response:
+            on_response(None, None)
+
+    @staticmethod
+    def form(data: bytes | None) -> aiohttp.FormData | None:
+        # FormData can be sent only once, so it's built on every attempt.
+        if data is None:
+            return
+
+        form = aiohttp.FormData()
+        form.add_field("map", data, filename="map.html", content_type="text/html")
+        return form
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=self.timeout)
+        return self.session
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.session and not self.session.closed:
+            await self.session.close()
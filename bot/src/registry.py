@@ -0,0 +1,103 @@
+import os
+import json
+
+import globals as g
+import geo
+
+logger = g.Logger(__name__)
+
+
+class TrackRegistry:
+    """Keeps opened compiled tracks in memory, keyed by race code.
+
+    Every entry remembers mtime and size of the compiled track on disk, so a
+    track recompiled after the GPX repo was pulled again is reopened on the next
+    access instead of serving stale geometry. Opening and compiling read from
+    disk, so get() runs in track.RACE_EXECUTOR, while the loop only evicts.
+    """
+
+    def __init__(self, tracks_dir: str):
+        self.tracks_dir = tracks_dir
+        self.tracks = {}
+
+    def path(self, race_code: str) -> str:
+        return os.path.join(self.tracks_dir, f"{race_code}.track")
+
+    def json_path(self, race_code: str) -> str:
+        return os.path.join(self.tracks_dir, f"{race_code}.json")
+
+    def stamp(self, race_code: str) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(os.path.join(self.path(race_code), "meta.npy"))
+        except FileNotFoundError:
+            return
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, race_code: str) -> geo.Track | None:
+        stamp = self.stamp(race_code)
+        entry = self.tracks.get(race_code)
+
+        if entry and stamp and entry[0] == stamp:
+            return entry[1]
+
+        if entry:
+            logger.info(f"Compiled track for {race_code} changed on disk, reloading.")
+            self.tracks.pop(race_code, None)
+
+        if not stamp:
+            stamp = self.compile(race_code)
+            if not stamp:
+                return
+
+        try:
+            track = geo.Track.load(self.path(race_code))
+        except Exception as e:
+            logger.error(f"Can't load compiled track for {race_code}: {e}")
+            return
+
+        self.tracks[race_code] = (stamp, track)
+
+        logger.info(
+            f"Compiled track for {race_code} loaded with {track.segments} segments, "
+            f"{len(self.tracks)} tracks in memory."
+        )
+
+        return track
+
+    def compile(self, race_code: str) -> tuple[int, int] | None:
+        """Compiles track from the JSON export if the compiled one is missing."""
+        json_path = self.json_path(race_code)
+        if not os.path.exists(json_path):
+            logger.error(f"Can't find JSON file with track data in path: {json_path}")
+            return
+
+        with open(json_path, "r") as json_file:
+            track_points = json.load(json_file)
+
+        logger.warning(
+            f"Compiled track for {race_code} is missing, compiling from JSON."
+        )
+
+        geo.Track(track_points).save(self.path(race_code))
+        return self.stamp(race_code)
+
+    def refresh(self):
+        """Drops entries whose compiled tracks were changed or removed on disk."""
+        for race_code, (stamp, _) in list(self.tracks.items()):
+            if self.stamp(race_code) != stamp:
+                self.tracks.pop(race_code, None)
+                logger.info(
+                    f"Track for {race_code} is outdated and removed from memory."
+                )
+
+    def retain(self, race_codes: list[str]):
+        """Evicts all tracks which are not referenced by the given race codes."""
+        for race_code in list(self.tracks):
+            if race_code not in race_codes:
+                self.tracks.pop(race_code, None)
+                logger.info(
+                    f"Track for {race_code} is not used and removed from memory."
+                )
+
+
+TRACKS = TrackRegistry(g.TRACKS_DIR)
@@ -0,0 +1,49 @@
+class Roster:
+    """Participants of the live race indexed by telegram id and race number.
+
+    Built once when the race starts, so live location updates and finish line
+    entries are resolved with dict lookups instead of database queries.
+    """
+
+    def __init__(self):
+        self.participants = {}
+        self.race_numbers = {}
+        self.finished = set()
+
+    @classmethod
+    def build(cls, participants: list[tuple]) -> "Roster":
+        """Builds roster from pairs of registration and user documents."""
+        roster = cls()
+
+        for registration, user in participants:
+            roster.add(
+                {
+                    "telegram_id": user.telegram_id,
+                    "full_name": f"{user.last_name} {user.first_name}",
+                    "category": registration.category,
+                    "race_number": int(registration.race_number),
+                }
+            )
+
+        return roster
+
+    def add(self, participant: dict):
+        self.participants[participant["telegram_id"]] = participant
+        # Race numbers are 0 until registration is closed.
+        if participant["race_number"]:
+            self.race_numbers[participant["race_number"]] = participant
+
+    def get(self, telegram_id: int) -> dict | None:
+        return self.participants.get(telegram_id)
+
+    def by_race_number(self, race_number: int) -> dict | None:
+        return self.race_numbers.get(race_number)
+
+    def finish(self, race_number: int):
+        self.finished.add(race_number)
+
+    def is_finished(self, race_number: int) -> bool:
+        return race_number in self.finished
+
+    def __len__(self):
+        return len(self.participants)
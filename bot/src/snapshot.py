@@ -0,0 +1,171 @@
+import os
+import asyncio
+import json
+import tempfile
+
+from datetime import datetime, timedelta
+
+import globals as g
+import database as db
+import registry
+import track as tr
+from history import RaceHistory
+from leaderboard import Leaderboard, LeaderboardFeed
+
+logger = g.Logger(__name__)
+
+# Seconds between snapshots of the ongoing race.
+SNAPSHOT_INTERVAL = 30
+
+# Races which started earlier than this are never restored.
+SNAPSHOT_MAX_AGE = timedelta(days=1)
+
+# Saves and removals of the snapshot never overlap.
+LOCK = asyncio.Lock()
+
+
+def dump() -> bytes:
+    """Serializes state of the ongoing race, must be called on the event loop."""
+    race = g.AppState.Race
+
+    state = {
+        "race_id": str(race.info.id),
+        "start_time": race.start_time,
+        "finishers": [
+            dict(finisher, race_time=finisher["race_time"].total_seconds())
+            for finisher in race.finishers
+        ],
+        "location_data": race.location_data,
+        "progress": race.progress,
+        "off_course": list(race.off_course),
+    }
+
+    return json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def write(data: bytes):
+    """Replaces the snapshot atomically, so a crash never leaves a partial one."""
+    with tempfile.NamedTemporaryFile(
+        dir=g.SNAPSHOT_DIR, suffix=".tmp", delete=False
+    ) as f:
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        except Exception:
+            os.remove(f.name)
+            raise
+
+    try:
+        os.replace(f.name, g.SNAPSHOT_PATH)
+    except Exception:
+        os.remove(f.name)
+        raise
+
+
+async def remove():
+    async with LOCK:
+        try:
+            os.remove(g.SNAPSHOT_PATH)
+            logger.info("Race snapshot removed.")
+        except FileNotFoundError:
+            pass
+
+
+async def save():
+    async with LOCK:
+        # Race could end while waiting for the previous save.
+        if not (g.AppState.Race.info and g.AppState.Race.ongoing):
+            return
+
+        data = dump()
+        await asyncio.get_running_loop().run_in_executor(None, write, data)
+
+    logger.debug(f"Race snapshot with {len(data)} bytes saved.")
+
+
+async def snapshot_loop():
+    logger.info(f"Race snapshots are saved every {SNAPSHOT_INTERVAL} seconds.")
+
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+        try:
+            await save()
+        except Exception:
+            logger.exception("Error while saving race snapshot.")
+
+
+async def restore() -> bool:
+    """Restores the ongoing race from the snapshot, returns True on success."""
+    try:
+        with open(g.SNAPSHOT_PATH, "rb") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception:
+        logger.exception("Can't read race snapshot, it will be ignored.")
+        return False
+
+    race_info = await db.get_race_by_id(state["race_id"])
+    # Snapshot of a race which wasn't ended properly is ignored on the next day.
+    stale = race_info and race_info.start < datetime.utcnow() - SNAPSHOT_MAX_AGE
+    if not race_info or race_info.ended or stale:
+        logger.warning("Race from the snapshot is not found or ended, ignoring it.")
+        await remove()
+        return False
+
+    race = g.AppState.Race
+    race.info = race_info
+    race.ongoing = True
+    race.start_time = state["start_time"]
+    race.finishers = [
+        dict(finisher, race_time=timedelta(seconds=finisher["race_time"]))
+        for finisher in state["finishers"]
+    ]
+
+    # JSON keys are strings, telegram ids are restored as ints.
+    race.location_data = {
+        int(telegram_id): user_info
+        for telegram_id, user_info in state["location_data"].items()
+    }
+    race.progress = {
+        int(telegram_id): tuple(rider_progress)
+        for telegram_id, rider_progress in state["progress"].items()
+    }
+    race.off_course = set(state["off_course"])
+
+    race.roster = await db.get_roster(race_info)
+    for finisher in race.finishers:
+        race.roster.finish(finisher["race_number"])
+
+    race.ranking = Leaderboard()
+    race.feed = LeaderboardFeed()
+    race.history = RaceHistory(race_info.distance)
+    race.map_published = False
+    race.map_sending = False
+    race.dirty = set()
+
+    for telegram_id, (progress, timestamp, _) in race.progress.items():
+        if telegram_id in race.location_data:
+            race.ranking.update(telegram_id, round(progress / 1000, 2))
+            race.history.record(
+                telegram_id,
+                timestamp,
+                progress,
+                race.location_data[telegram_id]["coordinates"],
+            )
+
+    registry.TRACKS.retain([race_info.code])
+    await tr.get_track(race_info.code)
+
+    # Map, leaderboard and positions are published again with the next tick.
+    for telegram_id in race.location_data:
+        tr.notify_location(telegram_id)
+
+    logger.info(
+        f"Race with name {race_info.name} restored from snapshot with "
+        f"{len(race.location_data)} riders and {len(race.finishers)} finishers."
+    )
+
+    return True
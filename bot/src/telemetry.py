@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import globals as g
+import database as db
+
+logger = g.Logger(__name__)
+
+
+class TelemetryWriter:
+    """Buffers live positions of riders and writes them to MongoDB in batches.
+
+    Handlers only append to the buffer, which is flushed with a single
+    insert_many every interval seconds or as soon as batch_size points are
+    collected. The write runs in a thread, so MongoDB never blocks the bot.
+    If MongoDB is unavailable, at most maxsize points are kept and the oldest
+    ones are dropped.
+    """
+
+    def __init__(self, batch_size: int = 500, interval: float = 5, maxsize=50_000):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.maxsize = maxsize
+
+        self.buffer = []
+        self.full = asyncio.Event()
+        self.task = None
+
+    def add(self, race, telegram_id: int, coordinates: list[float]):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+        self.buffer.append(
+            {
+                "race": race.id,
+                "telegram_id": telegram_id,
+                "timestamp": time.time(),
+                "coordinates": coordinates,
+            }
+        )
+
+        if len(self.buffer) >= self.batch_size:
+            self.full.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.full.clear()
+            await self.flush()
+
+    async def flush(self):
+        batch, self.buffer = self.buffer, []
+        if not batch:
+            return
+
+        try:
+            await db.insert_telemetry(batch)
+        except Exception:
+            logger.exception(f"Error while writing {len(batch)} telemetry points.")
+
+            # Points are kept for the next attempt, oldest ones are dropped first.
+            self.buffer = (batch + self.buffer)[-self.maxsize :]
+            return
+
+        logger.debug(f"Wrote {len(batch)} telemetry points to the database.")
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+
+
+WRITER = TelemetryWriter()
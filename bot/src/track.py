@@ -1,23 +1,53 @@
 import os
-import requests
+import asyncio
+import time
 import json
 import shutil
 
+from concurrent.futures import ThreadPoolExecutor
+
 import gpxpy
 import folium
 import numpy as np
 
-from aiocron import crontab
-from geopy.distance import geodesic
+from branca.element import MacroElement
+from jinja2 import Template
+
 from git import Repo
 
 import globals as g
+import geo
+import gpsfilter
+import registry
+from publisher import Publisher
 
 logger = g.Logger(__name__)
 
 POST_TOKEN = os.getenv("POST_TOKEN")
 POST_HOST = os.getenv("POST_HOST")
 
+PUBLISHER = Publisher(f"{POST_HOST}/post/", POST_TOKEN)
+
+# Response of the webserver to live data when it has no map.
+MAP_MISSING = "Map is missing"
+
+# Path on the webserver with JSON of rider positions, polled by the map.
+RIDERS_URL = "/live/riders/"
+
+# Set when new location data arrives, cleared by the race pipeline.
+LOCATION_UPDATED = asyncio.Event()
+
+# Projection and map rendering run here to keep bot handlers responsive. There's
+# a single worker, and the pipeline awaits every update, so at most one update
+# is in flight and the rest are coalesced in the dirty set.
+RACE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="race")
+
+
+async def get_track(race_code: str) -> geo.Track | None:
+    """Opens or compiles the track of the race in RACE_EXECUTOR."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(RACE_EXECUTOR, registry.TRACKS.get, race_code)
+
 
 async def download_gpx():
     shutil.rmtree(g.GH_DIR)
@@ -51,6 +81,12 @@ async def prepare_json_tracks():
 
     logger.info("All GPX files converted to JSON.")
 
+    registry.TRACKS.refresh()
+    if g.AppState.Race.info and g.AppState.Race.ongoing:
+        registry.TRACKS.retain([g.AppState.Race.info.code])
+    else:
+        registry.TRACKS.retain([])
+
     return race_codes
 
 
@@ -82,32 +118,184 @@ async def gpx_to_json(race_code) -> str | None:
 
     logger.info(f"Track points saved to {json_file_name}.")
 
+    if not track_points:
+        logger.error(f"GPX file {gpx_file_name} has no track points.")
+        return json_file_path
+
+    track = geo.Track(track_points)
+    track.save(registry.TRACKS.path(race_code))
+
+    logger.info(
+        f"Compiled track for {race_code} saved with {track.segments} segments and "
+        f"{len(track.index.cell_keys)} spatial index cells."
+    )
+
     return json_file_path
 
 
-def track_distance(track, coordinates):
-    track = np.array(track)
-    closest_point = min(track, key=lambda point: geodesic(coordinates, point).meters)
+def track_distance(
+    track: geo.Track,
+    coordinates: list,
+    previous: list,
+    velocity: list,
+    elapsed: list,
+    known: list,
+) -> tuple[list[float], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns distance along the track in km, progress in meters, velocity,
+    accepted and off course masks for riders.
+
+    Progress is searched near previous progress (meters) of every rider, the
+    window grows with elapsed seconds since the previous accepted position.
+    Positions are then filtered, so a single bad fix can't move a rider.
+    """
+    measured, offsets = track.follow(coordinates, previous, elapsed)
+    progress, velocity, accepted, off_course = gpsfilter.filter_progress(
+        measured, offsets, previous, velocity, elapsed, known
+    )
+
+    logger.debug(
+        f"Projected {len(coordinates)} positions on track, max offset is "
+        f"{offsets.max(initial=0):.0f} m, {int((~accepted).sum())} rejected."
+    )
+
+    return (
+        np.round(progress / 1000, 2).tolist(),
+        progress,
+        velocity,
+        accepted,
+        off_course,
+    )
+
+
+class RiderFeed(MacroElement):
+    """Polls JSON with rider positions and redraws their markers on the map.
+
+    Markers can also be pushed from the outside with window.updateRiders().
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            (function() {
+                var layer = L.layerGroup().addTo({{ this._parent.get_name() }});
+                var icon = L.AwesomeMarkers.icon({
+                    icon: "glyphicon glyphicon-record",
+                    iconColor: "white",
+                    markerColor: "red",
+                    prefix: "glyphicon",
+                });
+
+                function line(label, value) {
+                    var row = document.createElement("div");
+                    var name = document.createElement("b");
+                    name.textContent = label + ": ";
+                    row.appendChild(name);
+                    row.appendChild(document.createTextNode(value));
+                    return row;
+                }
+
+                function updateRiders(riders) {
+                    layer.clearLayers();
+                    riders.forEach(function(rider) {
+                        var popup = document.createElement("div");
+                        popup.appendChild(line("Имя", rider.full_name));
+                        popup.appendChild(line("Категория", rider.category));
+                        popup.appendChild(line("Номер", rider.race_number));
+                        L.marker([rider.lat, rider.lon], {icon: icon})
+                            .bindPopup(popup, {maxWidth: 300})
+                            .addTo(layer);
+                    });
+                }
+
+                function poll() {
+                    fetch({{ this.url|tojson }}, {cache: "no-cache"})
+                        .then(function(response) { return response.json(); })
+                        .then(updateRiders)
+                        .catch(function() {});
+                }
+
+                window.updateRiders = updateRiders;
+                poll();
+                setInterval(poll, {{ this.interval }});
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, url: str, interval: int):
+        super().__init__()
+        self._name = "RiderFeed"
+        self.url = url
+        self.interval = interval
+
+
+def render_map(track: geo.Track, location: list) -> bytes:
+    """Renders static folium map with the track, riders are loaded by RiderFeed.
+
+    The map is rendered once per race, so updates only cost the rider JSON.
+    """
+    m = folium.Map(location=location, zoom_start=13)
+
+    folium.PolyLine(track.points.tolist()).add_to(m)
+    RiderFeed(RIDERS_URL, max(g.MAP_UPDATE_INTERVAL, 5) * 1000).add_to(m)
+
+    m.save(g.MAP_PATH)
+
+    logger.debug(f"Map with {len(track.points)} track points saved to {g.MAP_PATH}.")
+
+    with open(g.MAP_PATH, "rb") as map_file:
+        return map_file.read()
+
+
+def rider_positions(location_data: dict) -> list[dict]:
+    return [
+        {
+            "lat": round(user_info["coordinates"][0], 5),
+            "lon": round(user_info["coordinates"][1], 5),
+            "full_name": user_info["full_name"],
+            "category": user_info["category"],
+            "race_number": user_info["race_number"],
+        }
+        for user_info in location_data.values()
+    ]
 
-    closest_point_index = np.where((track == closest_point).all(axis=1))[0][0]
 
-    logger.debug(f"Closest point on track for {coordinates} is {closest_point}.")
+def notify_location(telegram_id: int):
+    """Marks rider as changed and wakes up the race pipeline."""
+    g.AppState.Race.dirty.add(telegram_id)
+    LOCATION_UPDATED.set()
 
-    track_distance = 0.0
-    for i in range(closest_point_index):
-        point1 = track[i]
-        point2 = track[i + 1]
-        distance = geodesic(point1, point2).kilometers
-        track_distance += distance
 
-    logger.debug(f"Distance along track for {coordinates} is {track_distance} km.")
+async def race_pipeline():
+    """Publishes map and leaderboard after location updates.
 
-    return round(track_distance, 2)
+    Updates arriving while waiting are coalesced into the dirty set, so under
+    load the race is published at most once per MAP_UPDATE_INTERVAL seconds and
+    a quiet race isn't processed at all.
+    """
+    logger.info(
+        f"Race pipeline started with update interval {g.MAP_UPDATE_INTERVAL} seconds."
+    )
+
+    published = 0.0
+    while True:
+        await LOCATION_UPDATED.wait()
+
+        delay = g.MAP_UPDATE_INTERVAL - (time.monotonic() - published)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        LOCATION_UPDATED.clear()
+        published = time.monotonic()
+
+        try:
+            await race_map_create()
+        except Exception:
+            logger.exception("Error while processing race update.")
 
 
-@crontab(g.MAP_TICKRATE)
 async def race_map_create():
-    logger.debug("Crontab rule for race map creation triggered.")
+    logger.debug("Race pipeline triggered race map creation.")
 
     if not (g.AppState.Race.info and g.AppState.Race.ongoing):
         logger.debug("There's no active race at the moment.")
@@ -117,77 +305,115 @@ async def race_map_create():
         logger.debug("Race is active, but no location data received yet.")
         return
 
+    if not g.AppState.Race.dirty and g.AppState.Race.map_published:
+        logger.debug("No location updates since the last publish.")
+        return
+
     location = g.AppState.Race.info.location
     race_code = g.AppState.Race.info.code
 
     logger.info(f"Active race with code: {race_code}")
 
-    track_json_path = os.path.join(g.TRACKS_DIR, f"{race_code}.json")
-    if not os.path.exists(track_json_path):
-        logger.error(f"Can't find JSON file with track data in path: {track_json_path}")
+    track = await get_track(race_code)
+    if track is None:
         return
 
-    with open(track_json_path, "r") as json_file:
-        track = json.load(json_file)
+    logger.debug(f"Using compiled track with {len(track.points)} points.")
 
-    logger.debug(f"Loaded track with {len(track)} points from JSON file.")
+    location_data = g.AppState.Race.location_data
+    dirty, g.AppState.Race.dirty = g.AppState.Race.dirty, set()
 
-    m = folium.Map(location=location, zoom_start=13)
+    now = int(time.time())
+    start = g.AppState.Race.start_time or now
 
-    folium.PolyLine(track).add_to(m)
+    changed = [telegram_id for telegram_id in dirty if telegram_id in location_data]
+    coordinates = [location_data[telegram_id]["coordinates"] for telegram_id in changed]
+    states = [g.AppState.Race.progress.get(telegram_id) for telegram_id in changed]
+    known = [state is not None for state in states]
+    states = [state or (0.0, start, 0.0) for state in states]
+    previous = [progress for progress, _, _ in states]
+    elapsed = [max(now - timestamp, 0) for _, timestamp, _ in states]
+    velocity = [speed for _, _, speed in states]
 
-    raw_leaderboard = []
+    loop = asyncio.get_running_loop()
 
-    for telegram_id, user_info in g.AppState.Race.location_data.items():
-        description = (
-            f"<b>Имя:</b> {user_info['full_name']}<br>"
-            f"<b>Категория:</b> {user_info['category']}<br>"
-            f"<b>Номер:</b> {user_info['race_number']}\n"
+    if not (g.AppState.Race.map_published or g.AppState.Race.map_sending):
+        map_html = await loop.run_in_executor(
+            RACE_EXECUTOR, render_map, track, location
+        )
+        g.AppState.Race.map_sending = True
+        make_post("map", data=map_html, on_response=on_map_response)
+
+    results = []
+    if coordinates:
+        results = await loop.run_in_executor(
+            RACE_EXECUTOR,
+            track_distance,
+            track,
+            coordinates,
+            previous,
+            velocity,
+            elapsed,
+            known,
         )
 
-        coordinates = user_info["coordinates"]
-
-        folium.Marker(
-            location=coordinates,
-            popup=folium.Popup(html=description, max_width=300),
-            icon=folium.Icon(icon="glyphicon glyphicon-record", color="red"),
-        ).add_to(m)
-
-        logger.debug(f"Added marker for {user_info['full_name']}.")
-
-        distance = track_distance(track, coordinates)
-        leaderboard_entry = user_info.copy()
-        leaderboard_entry["distance"] = distance
-
-        raw_leaderboard.append(leaderboard_entry)
-
-        logger.debug(
-            f"Added {user_info['full_name']} to leaderboard with distance {distance}."
+    off_course = g.AppState.Race.off_course
+    for telegram_id, state, result in zip(changed, states, zip(*results)):
+        # Rider could finish while the update was computed.
+        if telegram_id not in g.AppState.Race.location_data:
+            continue
+
+        distance, rider_progress, rider_velocity, accepted, is_off_course = result
+
+        if is_off_course and telegram_id not in off_course:
+            logger.warning(f"Rider with telegram id {telegram_id} is off course.")
+        if is_off_course:
+            off_course.add(telegram_id)
+        else:
+            off_course.discard(telegram_id)
+
+        if not accepted:
+            # Elapsed time keeps growing from the last accepted position.
+            continue
+
+        g.AppState.Race.progress[telegram_id] = (
+            float(rider_progress),
+            now,
+            float(rider_velocity),
+        )
+        g.AppState.Race.ranking.update(telegram_id, distance)
+        g.AppState.Race.history.record(
+            telegram_id,
+            now,
+            float(rider_progress),
+            location_data[telegram_id]["coordinates"],
         )
 
-    m.save(g.MAP_PATH)
+    logger.debug(f"Updated distance for {len(changed)} riders with new positions.")
 
-    logger.debug(
-        f"Map created, added {len(g.AppState.Race.location_data)} markers. Saved to {g.MAP_PATH}."
-    )
+    await build_leaderboard()
 
-    await build_leaderboard(raw_leaderboard)
+    make_post(
+        "positions", json=rider_positions(location_data), on_response=on_live_response
+    )
 
 
-async def build_leaderboard(raw_leaderboard):
+async def build_leaderboard():
     if not g.AppState.Race.info:
         return
 
-    raw_leaderboard = sorted(raw_leaderboard, key=lambda x: x["distance"], reverse=True)
-
-    logger.debug(f"Sorted leaderboard data with {len(raw_leaderboard)} entries.")
+    location_data = g.AppState.Race.location_data
 
     leaderboard = []
-    for idx, entry in enumerate(raw_leaderboard):
+    for telegram_id, distance in g.AppState.Race.ranking:
+        entry = location_data.get(telegram_id)
+        if not entry:
+            continue
+
         leaderboard.append(
             {
-                "row_number": idx + 1,
-                "distance": f'{entry["distance"]} км',
+                "row_number": len(leaderboard) + 1,
+                "distance": f"{distance} км",
                 "category": entry["category"],
                 "race_number": entry["race_number"],
                 "full_name": entry["full_name"],
@@ -200,44 +426,45 @@ async def build_leaderboard(raw_leaderboard):
         f"Built leaderboard with {len(leaderboard)} entries and saved it in global state."
     )
 
-    make_post("leaderboard", json=leaderboard)
-    make_post("map")
+    message = g.AppState.Race.feed.message(leaderboard)
+    if message:
+        feed = g.AppState.Race.feed
+        make_post(
+            "leaderboard",
+            json=message,
+            on_response=lambda status, text: on_live_response(
+                status, text, feed.on_response
+            ),
+        )
 
 
-def make_post(request_type, json=None):
-    url = f"{POST_HOST}/post/"
+def on_map_response(status: int | None, text: str | None):
+    """Marks map as published only if the webserver has accepted it."""
+    g.AppState.Race.map_sending = False
+    g.AppState.Race.map_published = status is not None and 200 <= status < 300
 
-    logger.debug(f"Sending POST request with {request_type} to {url}.")
+    if not g.AppState.Race.map_published:
+        logger.warning(f"Map wasn't published, status {status}, will retry.")
+        LOCATION_UPDATED.set()
 
-    headers = {
-        "Content-Type": "application/json",
-        "post-token": POST_TOKEN,
-        "request-type": request_type,
-    }
-    if json:
-        try:
-            response = requests.post(url, headers=headers, json=json)
-            logger.info(f"POST request with JSON sent with response: {response.text}")
-        except Exception:
-            logger.error("Error while sending POST request with JSON.")
-        return
 
-    elif request_type == "race_state":
-        try:
-            response = requests.post(url, headers=headers, json=json)
-        except Exception:
-            logger.error("Error while sending POST request with race state.")
+def on_live_response(status: int | None, text: str | None, on_response=None):
+    """Sends the map again when the webserver reports it's missing."""
+    if status == 409 and text == MAP_MISSING:
+        logger.warning("Webserver has no map, it will be sent again.")
+        g.AppState.Race.map_published = False
+        LOCATION_UPDATED.set()
         return
 
-    else:
-        map_file = open(g.MAP_PATH, "rb")
-        files = {"map": map_file}
-        try:
-            response = requests.post(url, headers=headers, files=files)
-            logger.info(f"POST request with map sent with response: {response.text}")
-        except Exception:
-            logger.error("Error while sending POST request with map.")
-        return
+    if on_response:
+        on_response(status, text)
+
+
+def make_post(request_type, json=None, data=None, on_response=None):
+    """Queues POST request to the webserver, returns immediately."""
+    logger.debug(f"Queueing POST request with {request_type} to {PUBLISHER.url}.")
+
+    PUBLISHER.publish(request_type, json=json, data=data, on_response=on_response)
 
 
 test_data = ["name", "distance", "race_number", "category", "row_number"]
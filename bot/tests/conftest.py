@@ -0,0 +1,36 @@
+import functools
+import os
+import sys
+
+import mongoengine
+import mongomock
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(BOT_DIR, "src")
+DEV_ENV_FILE = os.path.join(BOT_DIR, "dev.env")
+
+sys.path.insert(0, SRC_DIR)
+
+# Modules of the bot read settings on import, values of an existing env file
+# don't override these.
+os.environ.update(
+    TOKEN="test", ADMINS="1", HOST="localhost", PORT="27017", DB="fatracingbot"
+)
+
+# globals refuses to start without an env file, an empty one is created for the
+# test session if there's none.
+CREATED_ENV_FILE = not (
+    os.path.exists(DEV_ENV_FILE) or os.path.exists(os.path.join(BOT_DIR, "prod.env"))
+)
+if CREATED_ENV_FILE:
+    open(DEV_ENV_FILE, "w").close()
+
+# database connects on import, so the client is replaced before it's imported.
+mongoengine.connect = functools.partial(
+    mongoengine.connect, mongo_client_class=mongomock.MongoClient
+)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if CREATED_ENV_FILE and os.path.exists(DEV_ENV_FILE):
+        os.remove(DEV_ENV_FILE)
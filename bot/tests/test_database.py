@@ -0,0 +1,104 @@
+import asyncio
+
+from datetime import date, datetime, timedelta
+
+import pytest
+from openpyxl import load_workbook
+
+import database as db
+
+
+@pytest.fixture
+def race():
+    for document in (db.User, db.Race, db.Registration, db.Payment):
+        document.drop_collection()
+
+    race = db.Race(
+        name="Test race",
+        start=datetime.utcnow() + timedelta(days=1),
+        location=[55.75, 37.61],
+        code="test",
+        categories=["Road", "Gravel"],
+        distance=100,
+        price=1000,
+    ).save()
+
+    async def register():
+        riders = [(1, "Road"), (2, "Gravel"), (3, "Road"), (4, "Road")]
+        for telegram_id, category in riders:
+            await db.new_user(
+                telegram_id=telegram_id,
+                first_name=f"Rider{telegram_id}",
+                last_name="Test",
+                gender="male",
+                birthday=date(1990, 1, telegram_id),
+                email=f"{telegram_id}@example.com",
+                phone=str(telegram_id),
+            )
+            assert await db.register_to_race(telegram_id, race.name, category)
+
+        # Registration of a user who was removed from the database.
+        db.Registration(race=race, telegram_id=5, category="Road").save()
+
+        await db.close_registration(race)
+
+    asyncio.run(register())
+    return race
+
+
+def test_register_to_race_is_idempotent(race):
+    assert asyncio.run(db.register_to_race(1, race.name, "Gravel"))
+
+    registration = asyncio.run(db.get_registration(race, 1))
+    assert registration.category == "Road"
+    assert db.Registration.objects(race=race, telegram_id=1).count() == 1
+    assert db.Payment.objects(race=race, telegram_id=1).count() == 1
+
+
+def test_get_roster(race, monkeypatch):
+    # Users are fetched in several batches.
+    monkeypatch.setattr(db, "PARTICIPANTS_BATCH_SIZE", 2)
+
+    roster = asyncio.run(db.get_roster(race))
+
+    assert len(roster) == 4
+    assert roster.get(5) is None
+    assert roster.get(1) == {
+        "telegram_id": 1,
+        "full_name": "Test Rider1",
+        "category": "Road",
+        "race_number": 101,
+    }
+    assert roster.by_race_number(102)["telegram_id"] == 3
+    assert roster.by_race_number(103)["telegram_id"] == 4
+    assert roster.by_race_number(201)["telegram_id"] == 2
+
+
+def test_create_participants_table(race, monkeypatch):
+    monkeypatch.setattr(db, "PARTICIPANTS_BATCH_SIZE", 2)
+
+    with asyncio.run(db.create_participants_table(race)) as table:
+        rows = list(load_workbook(table, read_only=True).active.values)
+
+    assert list(rows[0]) == db.PARTICIPANTS_COLUMNS
+    assert [row[0] for row in rows[1:]] == [101, 102, 103, 201]
+    assert list(rows[1]) == [
+        101,
+        "male",
+        "01.01.1990",
+        "Road",
+        "Test Rider1",
+        1,
+        "1",
+        "1@example.com",
+    ]
+
+
+def test_remove_participant(race):
+    info = asyncio.run(db.remove_participant(race, 3))
+
+    assert info["Имя"] == "Test Rider3"
+    assert info["Сумма платежа"] == 1000
+    assert asyncio.run(db.get_registration(race, 3)) is None
+    assert asyncio.run(db.get_payment(3, race)) is None
+    assert asyncio.run(db.remove_participant(race, 3)) is None
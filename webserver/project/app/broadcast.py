@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+import globals as g
+
+logger = g.Logger(__name__)
+
+
+class Broadcast:
+    """Fans out the latest live update to all connected viewers.
+
+    Update is serialized once by the publisher and the same bytes are handed to
+    every subscriber. Each subscriber queue holds only the latest update, so a
+    slow viewer skips intermediate updates instead of buffering them.
+    Publishing is thread-safe, since sync views run outside of the event loop.
+    """
+
+    def __init__(self):
+        self.message = None
+        self.version = None
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def publish(self, message: bytes, version: int):
+        with self.lock:
+            if self.version is not None and version < self.version:
+                return
+
+            self.message = message
+            self.version = version
+            subscribers = list(self.subscribers)
+
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(offer, queue, message)
+            except RuntimeError:
+                # Loop of the subscriber is already closed.
+                self.unsubscribe((loop, queue))
+
+        logger.debug(f"Live update broadcasted to {len(subscribers)} viewers.")
+
+    def subscribe(self) -> tuple[asyncio.AbstractEventLoop, asyncio.Queue]:
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=1))
+
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.message is not None:
+                offer(subscriber[1], self.message)
+
+        return subscriber
+
+    def watch(self, target):
+        """Starts target in a daemon thread once, used to follow other workers."""
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=target, daemon=True)
+                self.watcher.start()
+
+    def unsubscribe(self, subscriber: tuple[asyncio.AbstractEventLoop, asyncio.Queue]):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+
+def offer(queue: asyncio.Queue, message: bytes):
+    """Puts message into the queue, replacing the one which wasn't read yet."""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+
+BROADCAST = Broadcast()
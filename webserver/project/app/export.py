@@ -0,0 +1,46 @@
+import csv
+import io
+import tempfile
+
+from typing import BinaryIO
+
+from openpyxl import Workbook
+
+
+def write_xlsx(columns: list[str], rows) -> BinaryIO:
+    """Streams rows into a write-only workbook in a temporary file.
+
+    Rows can be any iterable, e.g. a generator over a database cursor, they're
+    written one by one and never collected in memory. Returned file is rewound
+    and removed when closed, so every export has its own file.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+
+    sheet.append(columns)
+    for row in rows:
+        sheet.append(row)
+
+    file = tempfile.TemporaryFile()
+    workbook.save(file)
+    file.seek(0)
+
+    return file
+
+
+def write_csv(columns: list[str], rows) -> BinaryIO:
+    """Streams rows into a CSV in a temporary file, same as write_xlsx."""
+    file = tempfile.TemporaryFile()
+
+    # BOM is added, so Excel opens Cyrillic text correctly.
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+
+    writer.writerow(columns)
+    writer.writerows(rows)
+
+    text.flush()
+    text.detach()
+    file.seek(0)
+
+    return file
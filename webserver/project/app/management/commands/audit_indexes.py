@@ -0,0 +1,72 @@
+"""Checks that every query of the webserver is served by an index.
+
+Runs explain() for each query against the configured database and fails if any
+of the winning plans contains COLLSCAN. Usage:
+
+    python manage.py audit_indexes
+"""
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+
+import globals as g
+
+from app import mongo
+
+logger = g.Logger(__name__)
+
+
+def queries() -> dict:
+    """Returns query sets built by the same functions as the webserver queries."""
+    now = mongo.get_day().now
+    race_id = ObjectId()
+
+    return {
+        "get_payment_statuses": mongo.payments_query(race_id),
+        "iter_participants": mongo.registrations_query(race_id, "race_number"),
+        "iter_participants users": mongo.users_query([0]),
+        "login": mongo.user_query(0),
+        "admin_event_download": mongo.race_query(race_id),
+        "get_races upcoming": mongo.upcoming_races_query(now),
+        "get_races ended": mongo.ended_races_query(now),
+    }
+
+
+def stages(plan) -> set[str]:
+    """Returns names of all stages in the query plan."""
+    found = set()
+
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            found.add(plan["stage"])
+        for value in plan.values():
+            found |= stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            found |= stages(value)
+
+    return found
+
+
+class Command(BaseCommand):
+    help = "Checks that every query of the webserver is served by an index."
+
+    def handle(self, *args, **options):
+        mongo.ensure_indexes()
+
+        failed = []
+        for name, queryset in queries().items():
+            plan = queryset.explain()["queryPlanner"]["winningPlan"]
+            plan_stages = stages(plan)
+
+            if "COLLSCAN" in plan_stages:
+                failed.append(name)
+                logger.error(f"Query {name} does COLLSCAN, stages: {plan_stages}.")
+            else:
+                logger.info(f"Query {name} uses stages: {plan_stages}.")
+
+        if failed:
+            raise CommandError(
+                f"{len(failed)} queries are not covered by indexes: {failed}."
+            )
+
+        logger.info("All queries are covered by indexes.")
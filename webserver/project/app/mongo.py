@@ -1,11 +1,7 @@
-import os
-
 from datetime import datetime
 from collections import namedtuple
-
-from django.conf import settings
-
-import pandas as pd
+from itertools import islice
+from typing import BinaryIO
 
 from mongoengine import (
     Document,
@@ -17,11 +13,25 @@ from mongoengine import (
     FloatField,
     BooleanField,
     ReferenceField,
-    DictField,
     SequenceField,
 )
 
-EXCEL_PATH = os.path.join(settings.APP_STATIC_DIR, "participants.xlsx")
+from . import export
+
+# Number of registrations for which users are fetched with a single query.
+PARTICIPANTS_BATCH_SIZE = 500
+
+PARTICIPANTS_COLUMNS = [
+    "Номер",
+    "Пол",
+    "Дата рождения",
+    "Категория",
+    "Полное имя",
+    "Telegram ID",
+    "Телефон",
+    "Email",
+    "Оплата",
+]
 
 
 class User(Document):
@@ -52,19 +62,26 @@ class Race(Document):
 
     registration_open = BooleanField(default=True)
 
-    participants = ListField(ReferenceField(User))
-    participants_infos = ListField(
-        DictField(
-            fields={
-                "telegram_id": IntField(required=True),
-                "category": StringField(required=True),
-                "race_number": IntField(default=0),
-            },
-        )
-    )
-
     ended = BooleanField(default=False)
 
+    # Not strict, since old documents may still have participants arrays which
+    # are moved to Registration by the bot on startup.
+    meta = {"indexes": [("name", "start"), "start"], "strict": False}
+
+
+class Registration(Document):
+    race = ReferenceField(Race, required=True)
+    telegram_id = IntField(required=True)
+    category = StringField(required=True)
+    race_number = IntField(default=0)
+
+    meta = {
+        "indexes": [
+            {"fields": ["race", "telegram_id"], "unique": True},
+            ("race", "race_number"),
+        ]
+    }
+
 
 class Payment(Document):
     payment_id = SequenceField(sequence_name="payment_id", required=True, unique=True)
@@ -77,11 +94,51 @@ class Payment(Document):
 
     verified = BooleanField(default=False)
 
+    meta = {"indexes": [("race", "telegram_id"), "verified"]}
+
+
+# Query sets are built by these functions only, so the audit_indexes command
+# explains exactly the queries which are sent to the database.
+def payments_query(race):
+    return Payment.objects(race=race)
+
+
+def user_query(telegram_id):
+    return User.objects(telegram_id=telegram_id)
 
-def get_payment_status(race: Race, telegram_id: int) -> bool | None:
-    payment = Payment.objects(race=race, telegram_id=telegram_id).first()
-    if payment:
-        return payment.verified
+
+def users_query(telegram_ids: list[int]):
+    return User.objects(telegram_id__in=telegram_ids)
+
+
+def registrations_query(race, order_by: str = "id"):
+    return Registration.objects(race=race).order_by(order_by)
+
+
+def race_query(race_id):
+    return Race.objects(id=race_id)
+
+
+def upcoming_races_query(now):
+    return Race.objects(start__gte=now).order_by("start")
+
+
+def ended_races_query(now):
+    return Race.objects(start__lte=now).order_by("-start")
+
+
+def ensure_indexes():
+    """Creates indexes declared in meta of the documents, if they're missing."""
+    for document in (User, Race, Registration, Payment):
+        document.ensure_indexes()
+
+
+def get_payment_statuses(race: Race) -> dict[int, bool]:
+    """Returns payment status of every participant of the race with a single query."""
+    payments = payments_query(race).only("telegram_id", "verified").as_pymongo()
+    return {
+        payment["telegram_id"]: payment.get("verified", False) for payment in payments
+    }
 
 
 def create_race(form_data):
@@ -121,42 +178,52 @@ def get_races(status: str):
     day = get_day()
 
     if status == "upcoming":
-        races = Race.objects(start__gte=day.now).order_by("start")
+        races = upcoming_races_query(day.now)
     elif status == "ended":
-        races = Race.objects(start__lte=day.now).order_by("-start")
+        races = ended_races_query(day.now)
 
     return races
 
 
-def create_participants_table(race):
-    participants = race.participants
-    participants_infos = race.participants_infos
-
-    table_entries = []
-    for participant, participant_info in zip(participants, participants_infos):
-        telegram_id = participant.telegram_id
-        payment_status = get_payment_status(race, telegram_id)
-        if payment_status:
-            payment_status = "Оплачено"
-        else:
-            payment_status = "Не оплачено"
-
-        entry = {
-            "Номер": participant_info["race_number"],
-            "Пол": participant.gender,
-            "Дата рождения": participant.birthday.strftime("%d.%m.%Y"),
-            "Категория": participant_info["category"],
-            "Полное имя": f"{participant.last_name} {participant.first_name}",
-            "Telegram ID": participant.telegram_id,
-            "Телефон": participant.phone,
-            "Email": participant.email,
-            "Оплата": payment_status,
-        }
-        table_entries.append(entry)
-
-    table_entries = sorted(table_entries, key=lambda x: x["Номер"])
-
-    df = pd.DataFrame(table_entries)
-    df.to_excel(EXCEL_PATH, index=False)
-
-    return EXCEL_PATH
+def iter_participants(race: Race, order_by: str = "id"):
+    """Yields registrations of the race with their users.
+
+    Registrations are read from a cursor and users are fetched with a single
+    query per batch, so memory doesn't grow with the number of participants.
+    """
+    registrations = iter(registrations_query(race, order_by))
+
+    while batch := list(islice(registrations, PARTICIPANTS_BATCH_SIZE)):
+        telegram_ids = [registration.telegram_id for registration in batch]
+        users = {user.telegram_id: user for user in users_query(telegram_ids)}
+
+        for registration in batch:
+            user = users.get(registration.telegram_id)
+            if user:
+                yield registration, user
+
+
+def create_participants_table(race: Race, file_format: str = "xlsx") -> BinaryIO:
+    """Returns temporary XLSX or CSV file with participants sorted by race number."""
+    payment_statuses = get_payment_statuses(race)
+
+    rows = (
+        [
+            registration.race_number,
+            participant.gender,
+            participant.birthday.strftime("%d.%m.%Y"),
+            registration.category,
+            f"{participant.last_name} {participant.first_name}",
+            participant.telegram_id,
+            participant.phone,
+            participant.email,
+            "Оплачено"
+            if payment_statuses.get(participant.telegram_id)
+            else "Не оплачено",
+        ]
+        for registration, participant in iter_participants(race, "race_number")
+    )
+
+    if file_format == "csv":
+        return export.write_csv(PARTICIPANTS_COLUMNS, rows)
+    return export.write_xlsx(PARTICIPANTS_COLUMNS, rows)
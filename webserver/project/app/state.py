@@ -0,0 +1,209 @@
+import os
+import json
+import secrets
+import threading
+import time
+
+from urllib.parse import urlparse
+
+import redis
+
+import globals as g
+
+logger = g.Logger(__name__)
+
+# Where the live state is stored:
+# memory - in the process, only for a single worker (default),
+# file:///path/to/dir - files in a directory shared by workers on one host,
+# redis://host:port/db - Redis, for workers in several containers.
+STATE_STORE = os.getenv("STATE_STORE", "memory")
+
+
+class MemoryStore:
+    """Keeps values in the process memory, can't be shared between workers."""
+
+    def __init__(self):
+        self.values = {}
+        self.stamps = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        return self.values.get(key)
+
+    def set(self, key: str, value: bytes | None):
+        with self.lock:
+            if value is None:
+                self.values.pop(key, None)
+            else:
+                self.values[key] = value
+            self.stamps[key] = self.stamps.get(key, 0) + 1
+
+    def stamp(self, key: str):
+        return self.stamps.get(key)
+
+
+class FileStore:
+    """Keeps every value in its own file, replaced atomically on write.
+
+    The directory can be shared by workers on the same host (or mounted into
+    several containers), stamp of a key is a single stat call.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return
+
+    def set(self, key: str, value: bytes | None):
+        if value is None:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            return
+
+        tmp_path = f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, self.path(key))
+
+    def stamp(self, key: str):
+        try:
+            stat = os.stat(self.path(key))
+        except FileNotFoundError:
+            return
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class RedisStore:
+    """Keeps values in Redis, every key has a counter which is used as stamp."""
+
+    def __init__(self, url: str):
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes | None):
+        pipeline = self.client.pipeline()
+        if value is None:
+            pipeline.delete(key)
+        else:
+            pipeline.set(key, value)
+        pipeline.incr(f"{key}:stamp")
+        pipeline.execute()
+
+    def stamp(self, key: str):
+        return self.client.get(f"{key}:stamp")
+
+
+def get_store(url: str = STATE_STORE):
+    scheme = urlparse(url).scheme
+
+    if url == "memory":
+        store = MemoryStore()
+    elif scheme == "file":
+        store = FileStore(urlparse(url).path)
+    elif scheme in ("redis", "rediss", "unix"):
+        store = RedisStore(url)
+    else:
+        raise ValueError(f"Unknown state store: {url}")
+
+    logger.info(f"Live state is stored in {type(store).__name__}.")
+    return store
+
+
+class AppState:
+    """Live race data shared by all workers through the store.
+
+    Every worker keeps a decoded copy and reloads it only when the stamp of
+    the state in the store has changed, which costs one stat or GET per request.
+    """
+
+    DEFAULTS = {
+        "race_is_live": False,
+        "leaderboard": [],
+        "leaderboard_version": 0,
+        "positions": [],
+        "epoch": None,
+        "version": 0,
+        "updated": 0,
+        "map_version": 0,
+        "map_updated": 0,
+    }
+
+    def __init__(self, store):
+        self.store = store
+        self.data = dict(self.DEFAULTS)
+        self.stamp = None
+
+        self.map_html = None
+        self.map_loaded = None
+
+        # Rendered pages of the current version, keyed by template and user type.
+        self.pages = {}
+        self.lock = threading.Lock()
+
+        self.load()
+        if not self.epoch:
+            # Epoch makes ETags from the previous run of the server invalid.
+            self.update(epoch=secrets.token_hex(4))
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["data"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def load(self):
+        """Reloads the state if another worker has changed it."""
+        stamp = self.store.stamp("state")
+        if stamp == self.stamp:
+            return
+
+        with self.lock:
+            raw = self.store.get("state")
+            data = dict(self.DEFAULTS)
+            if raw:
+                data.update(json.loads(raw))
+
+            if data["version"] != self.data["version"]:
+                self.pages = {}
+
+            self.data = data
+            self.stamp = stamp
+
+        if self.map_loaded != self.map_version:
+            self.map_html = self.store.get("map")
+            self.map_loaded = self.map_version
+
+    def update(self, **changes):
+        """Saves changes to the store and bumps version of the live data."""
+        self.load()
+
+        with self.lock:
+            data = dict(self.data, **changes)
+            data["version"] += 1
+            data["updated"] = time.time()
+
+            self.store.set("state", json.dumps(data, ensure_ascii=False).encode())
+
+            self.data = data
+            self.stamp = self.store.stamp("state")
+            self.pages = {}
+
+    def set_map(self, map_html: bytes | None):
+        self.store.set("map", map_html)
+        self.map_html = map_html
+
+        self.update(map_version=self.map_version + 1, map_updated=time.time())
+        self.map_loaded = self.map_version
@@ -8,6 +8,9 @@ urlpatterns = [
     path("login/", views.login, name="login"),
     path("post/", views.post, name="post"),
     path("live/", views.live, name="live"),
+    path("live/map/", views.live_map, name="live_map"),
+    path("live/riders/", views.riders, name="riders"),
+    path("live/stream/", views.live_stream, name="live_stream"),
     path("logout/", views.logout, name="logout"),
     path("admin/events", views.admin_events, name="admin_events"),
     path(
@@ -1,19 +1,33 @@
+import asyncio
 import json
+import mmap
 import os
+import tempfile
+import time
+
+from datetime import datetime
 
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib import auth
 from django.contrib.auth.models import User
-from django.http import HttpResponse, Http404, FileResponse
+from django.http import (
+    HttpResponse,
+    Http404,
+    FileResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.conf import settings
 
-from .mongo import User as MongoUser
-from .mongo import Race
 from .mongo import create_race, get_races, create_participants_table
+from .mongo import race_query, user_query
 from .utils import validate_login
 from .forms import NewRaceForm
+from .broadcast import BROADCAST
+from .state import AppState, get_store
 import globals as g
 
 logger = g.Logger(__name__)
@@ -24,14 +38,23 @@ POST_TOKEN = os.getenv("POST_TOKEN")
 ADMINS = [int(admin) for admin in os.getenv("ADMINS").split(",")]
 MAP_PATH = os.path.join(settings.APP_STATIC_DIR, "map.html")
 
+# Seconds between keepalive comments and max lifetime of a live stream. After
+# the lifetime the stream is closed and the browser reconnects by itself, so
+# streams of viewers which left are not kept forever.
+STREAM_KEEPALIVE = 15
+STREAM_LIFETIME = 600
+
+# Response to live data when the map must be sent again, checked by the bot.
+MAP_MISSING = "Map is missing"
 
-class AppState:
-    def __init__(self):
-        self.race_is_live = False
-        self.leaderboard = []
+# Size of chunks in bytes in which the uploaded map is written to disk.
+MAP_CHUNK_SIZE = 64 * 1024
 
+# Seconds between checks for updates posted to other workers.
+STREAM_WATCH_INTERVAL = 1
 
-APP_STATE = AppState()
+
+APP_STATE = AppState(get_store())
 
 
 def index(request):
@@ -69,12 +92,13 @@ def admin_events(request):
 
 @user_passes_test(lambda u: u.is_superuser)
 def admin_event_download(request, race_id: str):
-    race = Race.objects(id=race_id).first()
+    race = race_query(race_id).first()
 
-    table = create_participants_table(race)
+    file_format = "csv" if request.GET.get("format") == "csv" else "xlsx"
+    table = create_participants_table(race, file_format)
 
     response = FileResponse(
-        open(table, "rb"), as_attachment=True, filename="participants.xlsx"
+        table, as_attachment=True, filename=f"participants.{file_format}"
     )
     return response
 
@@ -105,7 +129,7 @@ def login(request):
 
     logger.debug(f"Trying to log in with telegram id {telegram_id}.")
 
-    mongo_user = MongoUser.objects(telegram_id=telegram_id).first()
+    mongo_user = user_query(telegram_id).first()
 
     if not mongo_user:
         logger.warning(f"User with telegram id {telegram_id} not found in database.")
@@ -173,23 +197,44 @@ def post(request):
     logger.debug(f"Request type: {request_type}")
 
     if request_type == "leaderboard":
-        leaderboard = json.loads(request.body)
+        message = json.loads(request.body)
 
-        APP_STATE.leaderboard = leaderboard
+        if isinstance(message, list):
+            # Plain list is the full leaderboard from the bot without versioning.
+            APP_STATE.update(leaderboard=message, leaderboard_version=0)
 
-        logger.info(f"Received leaderboard: {leaderboard} and saved it in app state.")
+            logger.info(f"Received leaderboard with {len(message)} rows.")
 
-        return HttpResponse("Success")
+            publish_live()
+
+            return live_data_accepted()
+
+        if not apply_leaderboard(message):
+            logger.warning(
+                f"Can't apply leaderboard version {message.get('version')} to "
+                f"version {APP_STATE.leaderboard_version}, snapshot requested."
+            )
+            return HttpResponse("Version mismatch", status=409)
+
+        logger.info(
+            f"Leaderboard updated to version {APP_STATE.leaderboard_version} "
+            f"with {len(message['rows'])} changed rows."
+        )
+
+        publish_live()
+
+        return live_data_accepted()
 
     elif request_type == "race_state":
         race_state = json.loads(request.body)
         logger.info(f"Received request to change race_state to: {race_state}.")
 
         if race_state == "start":
-            APP_STATE.race_is_live = True
+            APP_STATE.update(race_is_live=True)
 
         elif race_state == "stop":
-            APP_STATE.race_is_live = False
+            APP_STATE.set_map(None)
+            APP_STATE.update(race_is_live=False, positions=[])
             try:
                 os.remove(MAP_PATH)
                 logger.debug(f"Removed map from {MAP_PATH}.")
@@ -199,43 +244,246 @@ def post(request):
 
         logger.debug(f"Race state is now: {APP_STATE.race_is_live}.")
 
+        publish_live()
+
         return HttpResponse("Success")
 
-    elif request_type == "map":
-        logger.debug("Received map request.")
-        map_html = request.body.decode("utf-8")
+    elif request_type == "positions":
+        APP_STATE.update(positions=json.loads(request.body))
 
-        start_substring = "<!DOCTYPE html>"
-        end_substring = "</html>"
+        logger.info(f"Received positions of {len(APP_STATE.positions)} riders.")
 
-        start_index = map_html.find(start_substring)
-        end_index = map_html.find(end_substring)
+        publish_live()
 
-        if start_index == -1:
-            start_index = 0
+        return live_data_accepted()
 
-        html_content = map_html[start_index : end_index + len(end_substring)]
+    elif request_type == "map":
+        logger.debug("Received map request.")
 
-        logger.debug("Trying to receive map from request body.")
+        map_html = save_map(request)
+        if not map_html:
+            return HttpResponse("Empty map", status=400)
 
-        with open(MAP_PATH, "w") as f:
-            f.write(html_content)
+        APP_STATE.set_map(map_html)
 
         logger.info(f"Received map and saved it to {MAP_PATH}.")
 
+        publish_live()
+
         return HttpResponse("Success")
 
     return HttpResponse("Invalid request type", status=400)
 
 
+def live_data_accepted() -> HttpResponse:
+    """Asks the bot to send the map again if it's missing, e.g. after restart."""
+    if APP_STATE.map_html is None:
+        logger.warning("Live data received, but there's no map, requesting it.")
+        return HttpResponse(MAP_MISSING, status=409)
+
+    return HttpResponse("Success")
+
+
+def save_map(request) -> bytes | None:
+    """Streams uploaded map to disk and atomically replaces MAP_PATH with it.
+
+    Body of the request may contain multipart headers around the document, so
+    only the part from <!DOCTYPE html> to </html> is kept. The body is never
+    decoded or copied as a whole, it's searched and sliced through mmap, and a
+    request to the map never sees a partially written file.
+    """
+    map_dir = os.path.dirname(MAP_PATH)
+
+    with tempfile.NamedTemporaryFile(dir=map_dir, suffix=".tmp", delete=False) as f:
+        while chunk := request.read(MAP_CHUNK_SIZE):
+            f.write(chunk)
+        upload_path = f.name
+
+    try:
+        if not os.path.getsize(upload_path):
+            return
+
+        with open(upload_path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            start = max(mm.find(b"<!DOCTYPE html>"), 0)
+            end = mm.find(b"</html>", start)
+            end = len(mm) if end == -1 else end + len(b"</html>")
+
+            with memoryview(mm)[start:end] as html:
+                if start == 0 and end == len(mm):
+                    html_path = upload_path
+                else:
+                    with tempfile.NamedTemporaryFile(
+                        dir=map_dir, suffix=".tmp", delete=False
+                    ) as html_file:
+                        html_file.write(html)
+                        html_path = html_file.name
+
+                map_html = bytes(html)
+
+        os.replace(html_path, MAP_PATH)
+        return map_html
+    finally:
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+
+
+def apply_leaderboard(message: dict) -> bool:
+    """Applies versioned leaderboard snapshot or delta to the app state.
+
+    Delta contains rows whose position changed and the new size of the table,
+    rows are placed by their row_number. Returns False if the delta can't be
+    applied to the current version and the full snapshot is needed.
+    """
+    APP_STATE.load()
+
+    if message.get("full"):
+        APP_STATE.update(
+            leaderboard=message["rows"], leaderboard_version=message["version"]
+        )
+        return True
+
+    if message.get("base") != APP_STATE.leaderboard_version:
+        return False
+
+    size = message["size"]
+    leaderboard = APP_STATE.leaderboard[:size]
+    leaderboard.extend([None] * (size - len(leaderboard)))
+
+    for row in message["rows"]:
+        idx = row["row_number"] - 1
+        if not 0 <= idx < size:
+            return False
+        leaderboard[idx] = row
+
+    if None in leaderboard:
+        return False
+
+    APP_STATE.update(leaderboard=leaderboard, leaderboard_version=message["version"])
+    return True
+
+
+def user_type(request) -> str:
+    if request.user.is_superuser:
+        return "admin"
+    elif request.user.is_authenticated:
+        return "user"
+    return "anonymous"
+
+
+def live_etag(request, *args, **kwargs) -> str:
+    APP_STATE.load()
+    return f"{APP_STATE.epoch}-{APP_STATE.version}-{user_type(request)}"
+
+
+def live_last_modified(request, *args, **kwargs) -> datetime:
+    return datetime.utcfromtimestamp(int(APP_STATE.updated))
+
+
+def render_cached(request, template_name: str, context: dict) -> HttpResponse:
+    """Renders the template once per version of live data and user type."""
+    version = APP_STATE.version
+    key = (template_name, user_type(request))
+
+    content = APP_STATE.pages.get(key)
+    if content is not None:
+        return HttpResponse(content)
+
+    response = render(request, template_name, context)
+    if version == APP_STATE.version:
+        APP_STATE.pages[key] = response.content
+
+    return response
+
+
+@condition(etag_func=live_etag, last_modified_func=live_last_modified)
 def live(request):
-    return render(
+    return render_cached(
         request,
         "live.html",
         {"race_is_live": get_status(), "leaderboard": APP_STATE.leaderboard},
     )
 
 
+def map_etag(request, *args, **kwargs) -> str:
+    APP_STATE.load()
+    return f"{APP_STATE.epoch}-map-{APP_STATE.map_version}"
+
+
+def riders_etag(request, *args, **kwargs) -> str:
+    APP_STATE.load()
+    return f"{APP_STATE.epoch}-riders-{APP_STATE.version}"
+
+
+@condition(
+    etag_func=map_etag,
+    last_modified_func=lambda request: datetime.utcfromtimestamp(
+        int(APP_STATE.map_updated)
+    ),
+)
+def live_map(request):
+    if APP_STATE.map_html is None:
+        raise Http404
+
+    return HttpResponse(APP_STATE.map_html, content_type="text/html; charset=utf-8")
+
+
+def publish_live():
+    """Serializes current live data once and sends it to all stream viewers."""
+    data = json.dumps(
+        {
+            "race_is_live": get_status(),
+            "leaderboard": APP_STATE.leaderboard,
+            "positions": APP_STATE.positions,
+        },
+        ensure_ascii=False,
+    )
+    BROADCAST.publish(f"data: {data}\n\n".encode("utf-8"), APP_STATE.version)
+
+
+def watch_live():
+    """Sends updates which were posted to other workers to viewers of this one."""
+    while True:
+        time.sleep(STREAM_WATCH_INTERVAL)
+        try:
+            APP_STATE.load()
+            if APP_STATE.version != BROADCAST.version:
+                publish_live()
+        except Exception:
+            logger.exception("Error while checking live state for updates.")
+
+
+async def live_stream(request):
+    """Server-Sent Events stream with leaderboard and rider positions."""
+
+    async def events():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STREAM_LIFETIME
+        subscriber = BROADCAST.subscribe()
+        BROADCAST.watch(watch_live)
+
+        try:
+            yield b"retry: 5000\n\n"
+            while loop.time() < deadline:
+                try:
+                    yield await asyncio.wait_for(subscriber[1].get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+        finally:
+            BROADCAST.unsubscribe(subscriber)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@condition(etag_func=riders_etag, last_modified_func=live_last_modified)
+def riders(request):
+    return JsonResponse(APP_STATE.positions, safe=False)
+
+
 def tds(request):
     return render(request, "tds.html")
 
@@ -245,7 +493,8 @@ def tzar(request):
 
 
 def get_status():
-    if APP_STATE.race_is_live and APP_STATE.leaderboard and os.path.exists(MAP_PATH):
+    APP_STATE.load()
+    if APP_STATE.race_is_live and APP_STATE.leaderboard and APP_STATE.map_html:
         return True
     else:
         return False
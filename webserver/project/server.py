@@ -1,16 +1,16 @@
-from waitress import serve
+import uvicorn
 
-from django.contrib.staticfiles.handlers import StaticFilesHandler
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 
-from project.wsgi import application
+from project.asgi import application
 
 import globals as g
 
 logger = g.Logger(__name__)
-application = StaticFilesHandler(application)
+application = ASGIStaticFilesHandler(application)
 
 
 if __name__ == "__main__":
     PORT = 80
     logger.info(f"Starting server on port {PORT}.")
-    serve(application, port="80")
+    uvicorn.run(application, host="0.0.0.0", port=PORT)
@@ -0,0 +1,22 @@
+import os
+import sys
+
+WEBSERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_DIR = os.path.join(WEBSERVER_DIR, "project")
+DEV_ENV_FILE = os.path.join(WEBSERVER_DIR, "dev.env")
+
+sys.path.insert(0, PROJECT_DIR)
+
+# globals refuses to start without an env file, an empty one is created for the
+# test session if there's none.
+CREATED_ENV_FILE = not (
+    os.path.exists(DEV_ENV_FILE)
+    or os.path.exists(os.path.join(WEBSERVER_DIR, "prod.env"))
+)
+if CREATED_ENV_FILE:
+    open(DEV_ENV_FILE, "w").close()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if CREATED_ENV_FILE and os.path.exists(DEV_ENV_FILE):
+        os.remove(DEV_ENV_FILE)
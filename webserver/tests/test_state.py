@@ -0,0 +1,89 @@
+import pytest
+
+from app.state import AppState, FileStore, MemoryStore, get_store
+
+
+@pytest.fixture(params=["memory", "file"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStore()
+    return FileStore(str(tmp_path))
+
+
+def test_get_store(tmp_path):
+    assert isinstance(get_store("memory"), MemoryStore)
+
+    store = get_store(f"file://{tmp_path}")
+    assert isinstance(store, FileStore)
+    assert store.directory == str(tmp_path)
+
+    with pytest.raises(ValueError):
+        get_store("ftp://localhost")
+
+
+def test_store_round_trip(store):
+    assert store.get("state") is None
+    assert store.stamp("state") is None
+
+    store.set("state", b"first")
+    assert store.get("state") == b"first"
+    stamp = store.stamp("state")
+
+    store.set("state", b"second value")
+    assert store.get("state") == b"second value"
+    assert store.stamp("state") != stamp
+
+    store.set("state", None)
+    assert store.get("state") is None
+
+
+def test_state_defaults(store):
+    state = AppState(store)
+
+    assert state.race_is_live is False
+    assert state.leaderboard == []
+    assert state.epoch
+    assert state.version == 1
+
+    with pytest.raises(AttributeError):
+        state.missing
+
+
+def test_state_round_trip(store):
+    writer = AppState(store)
+    reader = AppState(store)
+
+    writer.update(race_is_live=True, leaderboard=[["Иванов", 10.5]])
+    reader.pages["index"] = "cached page"
+    reader.load()
+
+    assert reader.race_is_live is True
+    assert reader.leaderboard == [["Иванов", 10.5]]
+    assert reader.version == writer.version
+    # Pages rendered for the previous version are dropped.
+    assert reader.pages == {}
+
+    reader.update(race_is_live=False)
+    writer.load()
+
+    assert writer.race_is_live is False
+    assert writer.leaderboard == [["Иванов", 10.5]]
+    # Epoch is kept while the store is alive.
+    assert writer.epoch == reader.epoch
+
+
+def test_state_map_round_trip(store):
+    writer = AppState(store)
+    reader = AppState(store)
+
+    writer.set_map(b"<html>map</html>")
+    reader.load()
+
+    assert reader.map_html == b"<html>map</html>"
+    assert reader.map_version == 1
+
+    writer.set_map(None)
+    reader.load()
+
+    assert reader.map_html is None
+    assert reader.map_version == 2